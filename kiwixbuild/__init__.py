@@ -2,6 +2,7 @@
 
 import os, sys
 import argparse
+import pathlib
 
 from .dependencies import Dependency
 from .configs import ConfigInfo
@@ -9,6 +10,8 @@ from .builder import Builder
 from .flatpak_builder import FlatpakBuilder
 from . import _global
 from . import buildenv
+from . import stats
+from .utils import get_cpu_count, get_memory_limit, parse_size
 
 
 def parse_args():
@@ -41,6 +44,30 @@ def parse_args():
     parser.add_argument(
         "--config", choices=ConfigInfo.all_configs, default="native_dyn"
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "Maximum number of jobs run at the same time by all the commands "
+            "(shared through a make jobserver).\n"
+            "Default to the number of available cpus."
+        ),
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=None,
+        metavar="SIZE",
+        help=(
+            "Memory (in MiB, or with a M/G suffix) the build may use. Steps are "
+            "started and jobs allowed only while the memory they are expected "
+            "to use fits in it.\n"
+            "Default to the cgroup memory limit (or the physical memory)."
+        ),
+    )
     parser.add_argument(
         "--verbose",
         "-v",
@@ -126,6 +153,32 @@ def parse_args():
             "to develop with the cloned sources."
         ),
     )
+    subgroup.add_argument(
+        "--clone-mode",
+        choices=["full", "shallow", "blobless", "treeless"],
+        default=None,
+        help=(
+            "How to clone git repositories.\n"
+            "full: the whole history (default).\n"
+            "shallow: only the last commit (same as --fast-clone).\n"
+            "blobless: the whole history, file contents are downloaded when "
+            "needed.\n"
+            "treeless: the whole history, trees and file contents are "
+            "downloaded when needed.\n"
+            "Not used with --git-cache, clones share the mirror objects."
+        ),
+    )
+    subgroup.add_argument(
+        "--git-cache",
+        metavar="DIR",
+        default=os.environ.get("KBUILD_GIT_CACHE"),
+        help=(
+            "Keep a bare mirror of each cloned repository in DIR, updated once "
+            "per run. Sources are cloned from (and share objects with) the "
+            "mirrors, in all working dirs.\n"
+            "Default to the KBUILD_GIT_CACHE environment variable."
+        ),
+    )
     subgroup.add_argument(
         "--use-target-arch-name",
         action="store_true",
@@ -141,8 +194,142 @@ def parse_args():
     subgroup.add_argument(
         "--get-build-dir", action="store_true", help="Print the output directory."
     )
+    subgroup.add_argument(
+        "--mirror",
+        action="append",
+        metavar="URL",
+        help=(
+            "Try to download archives from URL/<archive name> (URL can also be a "
+            "local directory) in addition to their usual urls. The fastest "
+            "server is used. Can be given several times.\n"
+            "Default to the (space separated) KBUILD_MIRRORS environment variable."
+        ),
+    )
+    subgroup.add_argument(
+        "--download-cache",
+        metavar="DIR",
+        default=os.environ.get("KBUILD_DOWNLOAD_CACHE"),
+        help=(
+            "Share the downloaded archives between working dirs: archives are "
+            "stored in DIR (by sha256) and linked in the ARCHIVE dir.\n"
+            "Default to the KBUILD_DOWNLOAD_CACHE environment variable."
+        ),
+    )
+    subgroup.add_argument(
+        "--download-cache-size",
+        type=parse_size,
+        default=None,
+        metavar="SIZE",
+        help=(
+            "Remove the least recently used archives from the download cache "
+            "when it is bigger than SIZE (in MiB, or with a G suffix). Archives "
+            "still used by a working dir are kept."
+        ),
+    )
+    subgroup.add_argument(
+        "--source-cache",
+        metavar="DIR",
+        default=os.environ.get("KBUILD_SOURCE_CACHE"),
+        help=(
+            "Share the extracted and patched sources of archives between "
+            "working dirs: source trees are stored in DIR and copied (with "
+            "reflinks if supported) in the SOURCE dir.\n"
+            "Default to the KBUILD_SOURCE_CACHE environment variable."
+        ),
+    )
+    subgroup.add_argument(
+        "--source-cache-hardlink",
+        action="store_true",
+        help=(
+            "Hard link the files of the source cache if reflinks are not "
+            "supported. Sources must never be modified in place."
+        ),
+    )
+    subgroup.add_argument(
+        "--artifact-cache",
+        metavar="STORE",
+        help=(
+            "Restore the installed files of dependencies from STORE instead of "
+            "building them, if they have already been built with the same "
+            "sources, options, config and compilers.\n"
+            "STORE is a directory (built dependencies are added to it) or a "
+            "http(s) url (read only)."
+        ),
+    )
+    subgroup.add_argument(
+        "--trace-out",
+        metavar="FILE",
+        help=(
+            "Write the timeline of the build in FILE (Trace Event Format, "
+            "to open with Perfetto or chrome://tracing)."
+        ),
+    )
+    subgroup.add_argument(
+        "--plan",
+        action="store_true",
+        help=(
+            "Do not build, print the predicted critical path and wall-clock time "
+            "of the build (from the durations of previous builds)."
+        ),
+    )
+    subgroup.add_argument(
+        "--download-jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "Run up to N network commands (download, git clone/update) at the "
+            "same time when preparing sources."
+        ),
+    )
+    subgroup.add_argument(
+        "--extract-jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "Run up to N disk commands (extract, patch, ...) at the same time "
+            "when preparing sources."
+        ),
+    )
+    subgroup.add_argument(
+        "--decompressor",
+        choices=["auto", "python"],
+        default="auto",
+        help=(
+            "How to decompress tar archives.\n"
+            "auto: with pigz, xz, zstd or lbzip2 (multi-threaded) if installed, "
+            "python otherwise.\n"
+            "python: with the python modules only."
+        ),
+    )
+    subgroup.add_argument(
+        "--pipeline",
+        action="store_true",
+        help=(
+            "Do not wait for all sources to be prepared before building.\n"
+            "A dependency is built as soon as its own sources and its "
+            "dependencies are ready."
+        ),
+    )
+    subgroup.add_argument(
+        "--jobs-steps",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "Build up to N independent dependencies in parallel.\n"
+            "The output of each command is prefixed by the step it comes from."
+        ),
+    )
     options = parser.parse_args()
 
+    if not options.jobs:
+        options.jobs = get_cpu_count()
+    if not options.clone_mode:
+        options.clone_mode = "shallow" if options.fast_clone else "full"
+    if not options.max_memory:
+        options.max_memory = get_memory_limit()
     if not options.android_arch:
         options.android_arch = ["arm", "arm64", "x86", "x86_64"]
     if not options.ios_arch:
@@ -152,8 +339,27 @@ def parse_args():
 
 
 def main():
+    if sys.argv[1:2] == ["stats"]:
+        stats.main(sys.argv[2:])
+        return
     options = parse_args()
     options.working_dir = os.path.abspath(options.working_dir)
+    if options.trace_out:
+        options.trace_out = os.path.abspath(options.trace_out)
+    if options.mirror is None:
+        options.mirror = os.environ.get("KBUILD_MIRRORS", "").split()
+    options.mirror = [
+        mirror if "://" in mirror else pathlib.Path(os.path.abspath(mirror)).as_uri()
+        for mirror in options.mirror
+    ]
+    if options.download_cache:
+        options.download_cache = os.path.abspath(options.download_cache)
+    if options.source_cache:
+        options.source_cache = os.path.abspath(options.source_cache)
+    if options.git_cache:
+        options.git_cache = os.path.abspath(options.git_cache)
+    if options.artifact_cache and "://" not in options.artifact_cache:
+        options.artifact_cache = os.path.abspath(options.artifact_cache)
     _global.set_options(options)
     neutralEnv = buildenv.NeutralEnv(options.get_build_dir)
     _global.set_neutralEnv(neutralEnv)
@@ -1,9 +1,11 @@
 from collections import OrderedDict as _OrderedDict
 import platform
+import threading
 
 _neutralEnv = None
 _options = None
 _target_steps = _OrderedDict()
+_build_aborted = threading.Event()
 
 
 def set_neutralEnv(env):
@@ -38,3 +40,11 @@ def get_target_step(key, default_context=None):
 
 def target_steps():
     return _target_steps
+
+
+def abort_build():
+    _build_aborted.set()
+
+
+def build_aborted():
+    return _build_aborted.is_set()
@@ -1,9 +1,17 @@
 import os, sys, shutil
+import re
+import shlex
+import hashlib
 import subprocess
 import platform
 import distro
 
-from .utils import pj, download_remote, escape_path
+from .utils import pj, escape_path
+from .download import download_remote, DownloadCache
+from .jobserver import Jobserver
+from .stats import StatsDB
+from .trace import Tracer
+from .cache import ArtifactCache, SourceCache
 from ._global import neutralEnv, option
 
 
@@ -17,6 +25,24 @@ class NeutralEnv:
         for d in (self.source_dir, self.archive_dir, self.toolchain_dir, self.log_dir):
             os.makedirs(d, exist_ok=True)
         self.detect_platform()
+        self.download_cache = None
+        if option("download_cache"):
+            self.download_cache = DownloadCache(
+                option("download_cache"), option("download_cache_size")
+            )
+        self.stats = StatsDB(
+            pj(self.working_dir, "stats.sqlite"), option("target"), option("config")
+        )
+        self.tracer = Tracer(None if dummy_run else option("trace_out"))
+        self.artifact_cache = None
+        if option("artifact_cache"):
+            self.artifact_cache = ArtifactCache(option("artifact_cache"))
+        self.source_cache = None
+        if option("source_cache"):
+            self.source_cache = SourceCache(
+                option("source_cache"), option("source_cache_hardlink")
+            )
+        self.jobserver = None
         if dummy_run:
             # If this is for a dummy run, we will not run anything.
             # To check for command (and so, don't enforce their presence)
@@ -24,6 +50,7 @@ class NeutralEnv:
         self.ninja_command = self._detect_command(
             "ninja", default=[["ninja"], ["ninja-build"]]
         )
+        self.ninja_version = self._detect_version(self.ninja_command)
         self.meson_command = self._detect_command(
             "meson", default=[["meson.py"], ["meson"]]
         )
@@ -38,6 +65,8 @@ class NeutralEnv:
         self.qmake_command = self._detect_command(
             "qmake", required=False, default=[["qmake"], ["qmake6"]]
         )
+        if platform.system() != "Windows":
+            self.jobserver = Jobserver(option("jobs"))
 
     def detect_platform(self):
         _platform = platform.system()
@@ -49,7 +78,20 @@ class NeutralEnv:
 
     def download(self, what, where=None):
         where = where or self.archive_dir
-        download_remote(what, where)
+        download_remote(what, where, self.download_cache)
+
+    def _detect_version(self, command):
+        """The version of the command as a tuple of ints, () if unknown."""
+        try:
+            output = subprocess.run(
+                [*command, "--version"], capture_output=True, text=True
+            ).stdout
+        except OSError:
+            return ()
+        match = re.search(r"\d+(\.\d+)*", output)
+        if not match:
+            return ()
+        return tuple(int(v) for v in match.group().split("."))
 
     def _detect_command(self, name, default=None, options=["--version"], required=True):
         if default is None:
@@ -91,6 +133,7 @@ class BuildEnv:
             os.makedirs(d, exist_ok=True)
 
         self.libprefix = option("libprefix") or self._detect_libdir()
+        self._fingerprint = None
 
     def clean_intermediate_directories(self):
         for subdir in os.listdir(self.build_dir):
@@ -102,6 +145,57 @@ class BuildEnv:
             else:
                 os.remove(subpath)
 
+    # Environment variables changing the generated binaries.
+    fingerprint_env = (
+        "CC",
+        "CXX",
+        "AR",
+        "RANLIB",
+        "STRIP",
+        "CFLAGS",
+        "CXXFLAGS",
+        "CPPFLAGS",
+        "LDFLAGS",
+    )
+
+    @property
+    def fingerprint(self):
+        """Hash of the config settings and of the identity of its compilers.
+
+        The working directory is replaced by a placeholder, so the fingerprint
+        doesn't depend on where the build is done."""
+        if self._fingerprint is None:
+            env = self.get_env(
+                cross_comp_flags=True, cross_compilers=True, cross_path=True
+            )
+            inputs = [
+                self.configInfo.name,
+                str(self.configInfo),
+                self.libprefix,
+                *self.configInfo.configure_options,
+            ]
+            inputs += ["{}={}".format(k, env[k]) for k in self.fingerprint_env]
+            for crossfile in (self.meson_crossfile, self.cmake_crossfile):
+                if crossfile:
+                    with open(crossfile, "r") as f:
+                        inputs.append(f.read())
+            for compiler in (env["CC"] or "cc", env["CXX"] or "c++"):
+                try:
+                    inputs.append(
+                        subprocess.run(
+                            [*shlex.split(compiler), "--version"],
+                            env={k: str(v) for k, v in env.items()},
+                            capture_output=True,
+                            text=True,
+                            timeout=60,
+                        ).stdout
+                    )
+                except (OSError, subprocess.SubprocessError):
+                    pass
+            content = "\n".join(inputs).replace(option("working_dir"), "@WORKING_DIR@")
+            self._fingerprint = hashlib.sha256(content.encode()).hexdigest()
+        return self._fingerprint
+
     def _is_debianlike(self):
         return os.path.isfile("/etc/debian_version")
 
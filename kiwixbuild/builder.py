@@ -6,6 +6,15 @@ from .configs import ConfigInfo
 from .utils import remove_duplicates, StopBuild, colorize
 from .dependencies import Dependency
 from .packages import PACKAGE_NAME_MAPPERS
+from .scheduler import (
+    Scheduler,
+    MemoryBudget,
+    set_resource_limit,
+    get_priorities,
+    get_critical_path,
+    simulate,
+)
+from .stats import format_time
 from ._global import (
     neutralEnv,
     option,
@@ -31,6 +40,12 @@ class Builder:
                 ).format(config.name, neutralEnv("distname"))
             )
         self.targetDefs = config.add_targets(option("target"), self._targets)
+        self.memory_budget = MemoryBudget(
+            option("max_memory"),
+            option("jobs"),
+            self.get_job_memory,
+            neutralEnv("jobserver"),
+        )
 
     def finalize_target_steps(self):
         steps = []
@@ -102,26 +117,171 @@ class Builder:
             print(colorize("SKIP"))
             return
 
-        sourceDefs = remove_duplicates(
-            tDef for tDef in target_steps() if tDef[0] == "source"
+        sourceDefs = list(
+            remove_duplicates(tDef for tDef in target_steps() if tDef[0] == "source")
         )
-        for sourceDef in sourceDefs:
-            print("prepare sources {} :".format(sourceDef[1]))
-            source = get_target_step(sourceDef)
+        source_jobs = self.set_source_resource_limits()
+        if option("download_jobs") > 1 or option("extract_jobs") > 1:
+            steps = OrderedDict((sourceDef, set()) for sourceDef in sourceDefs)
+            Scheduler(steps, self.prepare_source, source_jobs).run()
+        else:
+            for sourceDef in sourceDefs:
+                self.prepare_source(sourceDef)
+
+    def set_source_resource_limits(self):
+        download_jobs = option("download_jobs")
+        extract_jobs = option("extract_jobs")
+        set_resource_limit("network", download_jobs)
+        set_resource_limit("disk", extract_jobs)
+        return download_jobs + extract_jobs
+
+    def prepare_source(self, sourceDef):
+        print("prepare sources {} :".format(sourceDef[1]))
+        source = get_target_step(sourceDef)
+        with neutralEnv("tracer").span("prepare {}".format(sourceDef[1]), "source"):
             source.prepare()
 
-    def build(self):
-        builderDefs = (tDef for tDef in target_steps() if tDef[0] != "source")
-        for builderDef in builderDefs:
-            builder = get_target_step(builderDef)
-            if option("make_dist") and builderDef[1] == option("target"):
-                print("make dist {} ({}):".format(builder.name, builderDef[0]))
-                builder.make_dist()
-                continue
-            print("build {} ({}):".format(builder.name, builderDef[0]))
-            add_target_step(builderDef, builder)
+    def get_step_dependencies(self, stepDef):
+        stepConfigName, stepName = stepDef
+        stepConfig = ConfigInfo.get_config(stepConfigName)
+        if stepName not in stepConfig.toolchain_names:
+            for tlcName in stepConfig.toolchain_names:
+                tlc = Dependency.all_deps[tlcName]
+                yield ("neutral" if tlc.neutral else stepConfigName, tlcName)
+        builder = get_target_step(stepDef)
+        for dep in builder.get_dependencies(stepConfig, True):
+            depDef = stepConfig.get_fully_qualified_dep(dep)
+            # Native icu4c depends on itself (used for cross-compilation).
+            if depDef != stepDef:
+                yield depDef
+
+    def get_job_memory(self, stepDef):
+        if stepDef[0] == "source":
+            return 0
+        target = Dependency.all_deps[stepDef[1]]
+        return (
+            neutralEnv("stats").get_max_rss(target.name) or target.memory_per_job or 0
+        )
+
+    def build_step(self, builderDef):
+        builder = get_target_step(builderDef)
+        if option("make_dist") and builderDef[1] == option("target"):
+            print("make dist {} ({}):".format(builder.name, builderDef[0]))
+            builder.make_dist()
+            return
+        print("build {} ({}):".format(builder.name, builderDef[0]))
+        add_target_step(builderDef, builder)
+        with neutralEnv("tracer").span("build {}".format(builder.name), builderDef[0]):
             builder.build()
 
+    def get_step_duration(self, stepDef):
+        stepConfig, stepName = stepDef
+        duration = neutralEnv("stats").get_duration(stepConfig, stepName)
+        if duration is None and stepConfig != "source":
+            duration = Dependency.all_deps[stepName].build_time
+        return duration or 0
+
+    def get_steps_graph(self, with_sources):
+        steps = OrderedDict()
+        for stepDef in target_steps():
+            if stepDef[0] == "source":
+                if with_sources:
+                    steps[stepDef] = set()
+            else:
+                deps = set(self.get_step_dependencies(stepDef))
+                if with_sources:
+                    deps.add(("source", stepDef[1]))
+                steps[stepDef] = deps
+        return steps
+
+    def build(self):
+        builderDefs = [tDef for tDef in target_steps() if tDef[0] != "source"]
+        if option("jobs_steps") > 1:
+            steps = self.get_steps_graph(with_sources=False)
+            Scheduler(
+                steps,
+                self.build_step,
+                option("jobs_steps"),
+                memory_budget=self.memory_budget,
+                priorities=get_priorities(steps, self.get_step_duration),
+            ).run()
+        else:
+            for builderDef in builderDefs:
+                self.memory_budget.update([builderDef])
+                self.build_step(builderDef)
+
+    def run_step(self, stepDef):
+        if stepDef[0] == "source":
+            self.prepare_source(stepDef)
+        else:
+            self.build_step(stepDef)
+
+    def prepare_and_build(self):
+        """Prepare sources and build in the same dependency graph.
+
+        A builder only waits for its own source (and its dependencies), so
+        compilation starts while other sources are still downloading."""
+        steps = self.get_steps_graph(not option("skip_source_prepare"))
+        source_jobs = self.set_source_resource_limits()
+        Scheduler(
+            steps,
+            self.run_step,
+            option("jobs_steps"),
+            source_jobs,
+            memory_budget=self.memory_budget,
+            priorities=get_priorities(steps, self.get_step_duration),
+        ).run()
+
+    def plan(self):
+        """Print the predicted critical path and wall-clock time of the build."""
+        with_sources = not option("skip_source_prepare")
+        source_jobs = option("download_jobs") + option("extract_jobs")
+        if option("pipeline"):
+            steps = self.get_steps_graph(with_sources)
+            priorities = get_priorities(steps, self.get_step_duration)
+            estimate = simulate(
+                steps,
+                self.get_step_duration,
+                option("jobs_steps"),
+                source_jobs,
+                priorities,
+            )
+        else:
+            steps = self.get_steps_graph(with_sources=False)
+            priorities = get_priorities(steps, self.get_step_duration)
+            estimate = simulate(
+                steps, self.get_step_duration, option("jobs_steps"), None, priorities
+            )
+            if with_sources:
+                sources = OrderedDict(
+                    (tDef, set()) for tDef in target_steps() if tDef[0] == "source"
+                )
+                if option("download_jobs") == option("extract_jobs") == 1:
+                    source_jobs = 1
+                estimate += simulate(sources, self.get_step_duration, source_jobs)
+        print("Critical path:")
+        for stepDef in get_critical_path(steps, priorities):
+            duration = self.get_step_duration(stepDef)
+            print(
+                "  {:<40} {:>10}".format(
+                    "{} ({})".format(stepDef[1], stepDef[0]),
+                    format_time(duration) if duration else "?",
+                )
+            )
+        print(
+            "Estimated wall-clock time: {} ({} step jobs)".format(
+                format_time(estimate), option("jobs_steps")
+            )
+        )
+        unknown = [s for s in steps if not self.get_step_duration(s)]
+        if unknown:
+            print(
+                colorize("WARNING")
+                + ": No duration known for {} steps, counted as 0s.".format(
+                    len(unknown)
+                )
+            )
+
     def _get_packages(self):
         packages_list = []
         for runningConfig in ConfigInfo.all_running_configs.values():
@@ -195,18 +355,32 @@ class Builder:
     def run(self):
         try:
             print("[INSTALL PACKAGES]")
-            if option("dont_install_packages"):
+            if option("plan"):
+                # Plan the steps of the real run: only drop the dependencies
+                # provided by packages, if they would be used.
+                if not option("dont_install_packages"):
+                    self._get_packages()
+                print(colorize("SKIP"))
+            elif option("dont_install_packages"):
                 print(colorize("SKIP"))
             else:
                 self.install_packages()
             self.finalize_target_steps()
+            if option("plan"):
+                print("[PLAN]")
+                self.plan()
+                return
             print("[SETUP TOOLCHAINS]")
             for config in ConfigInfo.all_running_configs.values():
                 config.finalize_setup()
-            print("[PREPARE]")
-            self.prepare_sources()
-            print("[BUILD]")
-            self.build()
+            if option("pipeline"):
+                print("[PREPARE AND BUILD]")
+                self.prepare_and_build()
+            else:
+                print("[PREPARE]")
+                self.prepare_sources()
+                print("[BUILD]")
+                self.build()
             # No error, clean intermediate file at end of build if needed.
             print("[CLEAN]")
             if option("clean_at_end"):
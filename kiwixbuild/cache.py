@@ -0,0 +1,204 @@
+import io
+import os
+import shutil
+import ssl
+import json
+import tarfile
+import tempfile
+import urllib.request
+import urllib.error
+
+from .utils import pj, SkipCommand, clone_tree
+from ._global import option
+
+METADATA_NAME = ".kiwix-build-artifact.json"
+
+
+def snapshot_tree(path):
+    """Map each file (or symlink) in `path` to its inode, ctime, mtime and size.
+
+    The ctime is changed by any write (even if the mtime is preserved, as
+    `install -p` or `copy2` do) and a replaced file has a new inode."""
+    snapshot = {}
+    for root, dirs, files in os.walk(path):
+        for name in files + [d for d in dirs if os.path.islink(pj(root, d))]:
+            file_path = pj(root, name)
+            st = os.lstat(file_path)
+            snapshot[os.path.relpath(file_path, path)] = (
+                st.st_ino,
+                st.st_ctime_ns,
+                st.st_mtime_ns,
+                st.st_size,
+            )
+    return snapshot
+
+
+def changed_files(before, after, installed=()):
+    """The files written between the `before` and `after` snapshots.
+
+    `installed` are the files listed in the install manifest of the build
+    system, which are included even if they were left untouched (already
+    up to date)."""
+    files = {f for f, info in after.items() if before.get(f) != info}
+    files.update(f for f in installed if f in after)
+    return sorted(files)
+
+
+class ArtifactCache:
+    """A content-addressed store of the files installed by dependencies.
+
+    Each artifact is a tar.gz of the files a dependency installed in the
+    INSTALL directory of its config, stored as `<name>/<name>-<key>.tar.gz`
+    where key is the fingerprint of everything affecting the build of the
+    dependency.
+
+    The store can be a directory (read and write, it can be shared between
+    developers or CI runners) or a http(s) url (read only).
+
+    Installed files may contain the install prefix. It is saved in the
+    artifact and replaced by the new prefix in the text files (and symlinks)
+    when the artifact is restored in another working directory."""
+
+    def __init__(self, store):
+        self.store = store
+        self.remote = store.startswith(("http://", "https://"))
+
+    def _artifact_path(self, name, key):
+        return "{0}/{0}-{1}.tar.gz".format(name, key)
+
+    def _open(self, name, key):
+        path = self._artifact_path(name, key)
+        if not self.remote:
+            try:
+                return open(pj(self.store, path), "rb")
+            except FileNotFoundError:
+                return None
+        if option("no_cert_check"):
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context = None
+        try:
+            return urllib.request.urlopen(
+                "{}/{}".format(self.store.rstrip("/"), path), context=context
+            )
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def restore(self, name, key, install_dir):
+        """Extract the artifact in `install_dir`. Return False if not in store."""
+        stream = self._open(name, key)
+        if stream is None:
+            return False
+        extra_args = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+        with stream, tarfile.open(fileobj=stream, mode="r|gz") as archive:
+            metadata = None
+            for member in archive:
+                if member.name == METADATA_NAME:
+                    metadata = json.load(archive.extractfile(member))
+                    old_prefix = metadata["prefix"]
+                    continue
+                if metadata is None:
+                    raise ValueError("Invalid artifact {}-{}".format(name, key))
+                dest = pj(install_dir, member.name)
+                if os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.remove(dest)
+                if old_prefix == install_dir:
+                    archive.extract(member, install_dir, **extra_args)
+                elif member.issym():
+                    member.linkname = member.linkname.replace(old_prefix, install_dir)
+                    archive.extract(member, install_dir, **extra_args)
+                elif member.isfile():
+                    data = archive.extractfile(member).read()
+                    if b"\0" not in data:
+                        data = data.replace(old_prefix.encode(), install_dir.encode())
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    with open(dest, "wb") as f:
+                        f.write(data)
+                    os.chmod(dest, member.mode)
+                else:
+                    archive.extract(member, install_dir, **extra_args)
+        return True
+
+    def save(self, name, key, install_dir, files):
+        """Store `files` (relative to `install_dir`) as the artifact of `name`."""
+        if self.remote:
+            raise SkipCommand("Remote store is read only")
+        path = pj(self.store, self._artifact_path(name, key))
+        if os.path.exists(path):
+            raise SkipCommand("Already in store")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        metadata = json.dumps({"name": name, "key": key, "prefix": install_dir})
+        metadata = metadata.encode()
+        # Write in a temporary file first, so concurrent builds sharing the
+        # store never see a partial artifact.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, tarfile.open(
+                fileobj=f, mode="w:gz", compresslevel=1
+            ) as archive:
+                info = tarfile.TarInfo(METADATA_NAME)
+                info.size = len(metadata)
+                archive.addfile(info, io.BytesIO(metadata))
+                for file in files:
+                    archive.add(pj(install_dir, file), arcname=file, recursive=False)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class SourceCache:
+    """A store of extracted and patched source trees.
+
+    Each tree is stored as `<name>/<name>-<key>` where key is the fingerprint
+    of the sources (archives and patches). The trees are copied with reflinks
+    if the filesystem supports it, so new working dirs get their sources
+    almost for free. If `hardlink`, files are hard linked when reflinks are
+    not supported; sources must then never be modified in place."""
+
+    def __init__(self, path, hardlink=False):
+        self.path = path
+        self.hardlink = hardlink
+
+    def _tree_path(self, name, key):
+        return pj(self.path, name, "{}-{}".format(name, key))
+
+    def _clone(self, src, dst):
+        # Clone in a temporary dir first, so a partial tree is never used.
+        tmp_path = "{}.tmp{}".format(dst, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        try:
+            clone_tree(src, tmp_path, self.hardlink)
+            os.rename(tmp_path, dst)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def restore(self, name, key, source_path):
+        """Copy the tree in `source_path`. Return False if not in store."""
+        tree_path = self._tree_path(name, key)
+        if not os.path.isdir(tree_path):
+            return False
+        if os.path.exists(source_path):
+            shutil.rmtree(source_path)
+        self._clone(tree_path, source_path)
+        return True
+
+    def save(self, name, key, source_path):
+        tree_path = self._tree_path(name, key)
+        if os.path.exists(tree_path):
+            raise SkipCommand("Already in store")
+        os.makedirs(os.path.dirname(tree_path), exist_ok=True)
+        try:
+            self._clone(source_path, tree_path)
+        except OSError:
+            # Saved by a concurrent build.
+            if os.path.exists(tree_path):
+                raise SkipCommand("Already in store")
+            raise
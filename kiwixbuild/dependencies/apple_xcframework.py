@@ -99,8 +99,8 @@ class AppleXCFramework(Dependency):
 
         def build(self):
             xcf_libs = []
-            self.command("remove_if_exists", self._remove_if_exists)
-            xcf_libs += self.command("merge_libs", self._merge_libs)
+            self.install_command("remove_if_exists", self._remove_if_exists)
+            xcf_libs += self.install_command("merge_libs", self._merge_libs)
             xcf_libs += self.command(
                 "make_macos_fat",
                 self.make_fat_with,
@@ -113,4 +113,4 @@ class AppleXCFramework(Dependency):
                 AppleXCFramework.iossimulator_subconfigs,
                 "ios-simulator_fat",
             )
-            self.command("build_xcframework", self._build_xcframework, xcf_libs)
+            self.install_command("build_xcframework", self._build_xcframework, xcf_libs)
@@ -21,7 +21,7 @@ class Aria2(Dependency):
 
         class Builder(NoopBuilder):
             def build(self):
-                self.command("copy_binary", self._copy_binary)
+                self.install_command("copy_binary", self._copy_binary)
 
             def _copy_binary(self, context):
                 context.try_skip(self.build_path)
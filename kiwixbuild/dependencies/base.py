@@ -2,7 +2,12 @@ import subprocess
 import os
 import shutil
 import time
+import hashlib
+import inspect
 import platform
+import threading
+import functools
+import json
 
 from kiwixbuild.utils import (
     pj,
@@ -14,12 +19,51 @@ from kiwixbuild.utils import (
     run_command,
     colorize,
     copy_tree,
+    file_lock,
+    FrozenEnv,
 )
 from kiwixbuild.versions import main_project_versions, base_deps_versions
 from kiwixbuild._global import neutralEnv, option, get_target_step
+from kiwixbuild.scheduler import use_resource
+from kiwixbuild.cache import snapshot_tree, changed_files
 
 SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
+# Held while a builder writes in the install dir (install or restore from
+# the cache), so the files installed by other builders are never mixed in
+# the artifact of a cached build.
+_install_lock = threading.Lock()
+
+
+def hash_inputs(inputs):
+    """Hash a list of strings, None if one of them is unknown (None)."""
+    if any(i is None for i in inputs):
+        return None
+    return hashlib.sha256("\n".join(inputs).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def record_command(config, target, name, status, start_time, context, exit_code):
+    """Store the execution of a command in the stats database and the trace."""
+    neutralEnv("stats").record(
+        config, target, name, status, start_time, context, exit_code
+    )
+    neutralEnv("tracer").add_span(
+        "{} {}".format(name, target.name),
+        config,
+        start_time,
+        args={
+            "status": status,
+            "cpu_time": context.cpu_time,
+            "max_rss": context.max_rss,
+        },
+    )
+
 
 class _MetaDependency(type):
     def __new__(cls, name, bases, dct):
@@ -35,6 +79,11 @@ class Dependency(metaclass=_MetaDependency):
     force_build = False
     force_native_build = False
     dont_skip = False
+    # Peak memory (in MiB) of one compilation job and duration (in seconds)
+    # of the build. Used as hints to schedule the build until the real values
+    # have been measured.
+    memory_per_job = None
+    build_time = None
 
     @classmethod
     def version(cls):
@@ -56,6 +105,9 @@ class Source:
     A source preparator must install source in the self.source_dir attribute
     inside the neutralEnv.source_dir."""
 
+    # Commands limited by the network. All others are limited by the disk.
+    network_commands = ("download", "gitmirror", "gitinit", "gitupdate")
+
     def __init__(self, target):
         self.target = target
 
@@ -79,6 +131,22 @@ class Source:
     def _log_dir(self):
         return neutralEnv("log_dir")
 
+    def get_fingerprint_inputs(self, strict):
+        yield self.name
+        yield str(self.target.version())
+        for p in getattr(self, "patches", []):
+            yield hash_file(pj(SCRIPT_DIR, "patches", p))
+
+    @property
+    def fingerprint(self):
+        """Hash of the prepared sources, None if it cannot be known."""
+        return hash_inputs(list(self.get_fingerprint_inputs(True)))
+
+    @property
+    def local_fingerprint(self):
+        """Hash of the current state of the sources (including local changes)."""
+        return hash_inputs(list(self.get_fingerprint_inputs(False)))
+
     def _patch(self, context):
         context.try_skip(self.source_path)
         for p in self.patches:
@@ -89,19 +157,27 @@ class Source:
     def command(self, name, function, *args):
         print("  {} {} : ".format(name, self.name), end="", flush=True)
         log = pj(self._log_dir, "cmd_{}_{}.log".format(name, self.name))
-        context = Context(name, log, True)
+        context = Context(name, log, True, lambda: self.local_fingerprint)
+        resource = "network" if name in self.network_commands else "disk"
+        status, exit_code = "ERROR", 0
+        start_time = time.time()
         try:
-            start_time = time.time()
-            ret = function(*args, context=context)
-            context._finalise()
-            duration = time.time() - start_time
+            with use_resource(resource):
+                start_time = time.time()
+                ret = function(*args, context=context)
+                context._finalise()
+                duration = time.time() - start_time
+            status = "OK"
             print(colorize("OK"), "({:.1f}s)".format(duration))
             return ret
         except WarningMessage as e:
+            status = "WARNING"
             print(e)
         except SkipCommand as e:
+            status = "SKIP"
             print(e)
-        except subprocess.CalledProcessError:
+        except subprocess.CalledProcessError as e:
+            exit_code = e.returncode
             print(colorize("ERROR"))
             try:
                 with open(log, "r") as f:
@@ -112,6 +188,10 @@ class Source:
         except:
             print(colorize("ERROR"))
             raise
+        finally:
+            record_command(
+                "source", self.target, name, status, start_time, context, exit_code
+            )
 
 
 class NoopSource(Source):
@@ -121,6 +201,9 @@ class NoopSource(Source):
 
 class ReleaseDownload(Source):
     archive_top_dir = None
+    # Globs (relative to the top dir) of the archive members to extract or not.
+    extract_include = None
+    extract_exclude = ()
 
     @property
     def archives(self):
@@ -130,6 +213,15 @@ class ReleaseDownload(Source):
     def extract_path(self):
         return pj(neutralEnv("source_dir"), self.source_dir)
 
+    def get_fingerprint_inputs(self, strict):
+        yield from super().get_fingerprint_inputs(strict)
+        for archive in self.archives:
+            yield archive.name
+            yield archive.sha256 or (None if strict else "")
+        if self.extract_include or self.extract_exclude:
+            yield str(self.extract_include)
+            yield str(self.extract_exclude)
+
     def _download(self, context):
         context.try_skip(neutralEnv("archive_dir"), self.full_name)
         archive_iter = iter(self.archives)
@@ -144,6 +236,29 @@ class ReleaseDownload(Source):
                 continue
             archive = next(archive_iter, None)
 
+    def _restore_sources(self, context):
+        try:
+            with open(pj(self.extract_path, ".extract_ok"), "r") as f:
+                if f.read() == context.inputs:
+                    raise SkipCommand()
+        except FileNotFoundError:
+            pass
+        key = self.fingerprint
+        if key is None:
+            raise SkipCommand("Unknown sources")
+        if not neutralEnv("source_cache").restore(self.name, key, self.extract_path):
+            raise SkipCommand("Not in cache")
+
+    def _save_sources(self, context):
+        # Only save freshly prepared sources, not the ones of a previous run
+        # (they may have been modified since).
+        if not self._extracted:
+            raise SkipCommand()
+        key = self.fingerprint
+        if key is None:
+            raise SkipCommand("Unknown sources")
+        neutralEnv("source_cache").save(self.name, key, self.extract_path)
+
     def _extract(self, context):
         context.try_skip(self.extract_path)
         if os.path.exists(self.extract_path):
@@ -154,20 +269,41 @@ class ReleaseDownload(Source):
                 neutralEnv("source_dir"),
                 topdir=self.archive_top_dir,
                 name=self.source_dir,
+                decompressor=option("decompressor"),
+                include=self.extract_include,
+                exclude=self.extract_exclude,
             )
 
+    def _extract_sources(self, context):
+        # Not done in `_extract`, which is overridden by some sources.
+        self._extract(context)
+        self._extracted = True
+
     def prepare(self):
         self.command("download", self._download)
-        self.command("extract", self._extract)
+        # Restored sources contain the stamps of the following commands.
+        if neutralEnv("source_cache") is not None:
+            self.command("restore_sources", self._restore_sources)
+        self._extracted = False
+        self.command("extract", self._extract_sources)
         if hasattr(self, "patches"):
             self.command("patch", self._patch)
         if hasattr(self, "_post_prepare_script"):
             self.command("post_prepare_script", self._post_prepare_script)
+        if neutralEnv("source_cache") is not None:
+            self.command("save_sources", self._save_sources)
 
 
 class GitClone(Source):
     base_git_ref = "main"
     force_full_clone = False
+    # Options of `git clone` for each --clone-mode.
+    clone_mode_options = {
+        "full": [],
+        "shallow": ["--depth=1"],
+        "blobless": ["--filter=blob:none"],
+        "treeless": ["--filter=tree:0"],
+    }
 
     @property
     def release_git_ref(self):
@@ -191,12 +327,115 @@ class GitClone(Source):
         else:
             return self.base_git_ref
 
+    def _git_output(self, *args):
+        return subprocess.check_output(
+            [*neutralEnv("git_command"), *args], cwd=self.git_path
+        )
+
+    def get_fingerprint_inputs(self, strict):
+        yield from super().get_fingerprint_inputs(strict)
+        try:
+            commit = self._git_output("rev-parse", "HEAD").decode().strip()
+            untracked = self._git_output(
+                "ls-files", "--others", "--exclude-standard", "-z"
+            ).split(b"\0")
+            diff = self._git_output("diff", "HEAD", "--binary")
+        except (OSError, subprocess.CalledProcessError):
+            yield None if strict else ""
+            return
+        yield commit
+        untracked = [f.decode() for f in untracked if f]
+        if not diff and not untracked:
+            return
+        if strict:
+            # Local changes cannot be known by others.
+            yield None
+            return
+        yield hashlib.sha256(diff).hexdigest()
+        for f in untracked:
+            st = os.stat(pj(self.git_path, f))
+            yield "{} {} {}".format(f, st.st_mtime_ns, st.st_size)
+
+    @property
+    def clone_mode(self):
+        if option("clone_mode") == "shallow" and self.force_full_clone:
+            return "full"
+        return option("clone_mode")
+
+    @property
+    def git_mirror_path(self):
+        url_hash = hashlib.sha256(self.git_remote.encode()).hexdigest()[:8]
+        return pj(option("git_cache"), "{}-{}.git".format(self.name, url_hash))
+
+    def _git_mirror_lock(self, shared=False):
+        # The cache may be shared by several builds at the same time.
+        return file_lock(self.git_mirror_path + ".lock", shared)
+
+    def _git_mirror(self, context):
+        os.makedirs(option("git_cache"), exist_ok=True)
+        with self._git_mirror_lock():
+            if not os.path.exists(self.git_mirror_path):
+                command = [
+                    *neutralEnv("git_command"),
+                    "clone",
+                    "--bare",
+                    self.git_remote,
+                    self.git_mirror_path,
+                ]
+                run_command(command, option("git_cache"), context)
+                # Checkouts borrow objects from the mirror, they must never be
+                # pruned, even if the upstream history is rewritten.
+                command = [
+                    *neutralEnv("git_command"),
+                    "config",
+                    "gc.pruneExpire",
+                    "never",
+                ]
+                run_command(command, self.git_mirror_path, context)
+                # Fetch only the branches and tags, not all the refs as a
+                # `--mirror` would (the refs/pull/* of GitHub).
+                for action, refspec in (
+                    ("--replace-all", "+refs/heads/*:refs/heads/*"),
+                    ("--add", "+refs/tags/*:refs/tags/*"),
+                ):
+                    command = [
+                        *neutralEnv("git_command"),
+                        "config",
+                        action,
+                        "remote.origin.fetch",
+                        refspec,
+                    ]
+                    run_command(command, self.git_mirror_path, context)
+            else:
+                command = [*neutralEnv("git_command"), "fetch", "--prune", "origin"]
+                run_command(command, self.git_mirror_path, context)
+
     def _git_init(self, context):
-        if option("fast_clone") and self.force_full_clone == False:
+        if option("git_cache"):
+            command = [
+                *neutralEnv("git_command"),
+                "clone",
+                "--shared",
+                self.git_mirror_path,
+                self.source_dir,
+            ]
+            with self._git_mirror_lock(shared=True):
+                run_command(command, neutralEnv("source_dir"), context)
+            command = [
+                *neutralEnv("git_command"),
+                "remote",
+                "set-url",
+                "origin",
+                self.git_remote,
+            ]
+            run_command(command, self.git_path, context)
+            command = [*neutralEnv("git_command"), "checkout", self.git_ref]
+            run_command(command, self.git_path, context)
+        elif self.clone_mode == "shallow":
             command = [
                 *neutralEnv("git_command"),
                 "clone",
-                "--depth=1",
+                *self.clone_mode_options["shallow"],
                 "--branch",
                 self.git_ref,
                 self.git_remote,
@@ -204,9 +443,12 @@ class GitClone(Source):
             ]
             run_command(command, neutralEnv("source_dir"), context)
         else:
+            # Partial clones (blobless, treeless) keep their filter in the
+            # config of the remote, following fetches use it too.
             command = [
                 *neutralEnv("git_command"),
                 "clone",
+                *self.clone_mode_options[self.clone_mode],
                 self.git_remote,
                 self.source_dir,
             ]
@@ -215,8 +457,20 @@ class GitClone(Source):
             run_command(command, self.git_path, context)
 
     def _git_update(self, context):
-        command = [*neutralEnv("git_command"), "fetch", "origin", self.git_ref]
-        run_command(command, self.git_path, context)
+        if option("git_cache"):
+            # The mirror is already up to date, fetch from it.
+            command = [
+                *neutralEnv("git_command"),
+                "fetch",
+                "--tags",
+                self.git_mirror_path,
+                "+refs/heads/*:refs/remotes/origin/*",
+            ]
+            with self._git_mirror_lock(shared=True):
+                run_command(command, self.git_path, context)
+        else:
+            command = [*neutralEnv("git_command"), "fetch", "origin", self.git_ref]
+            run_command(command, self.git_path, context)
         try:
             command = [
                 *neutralEnv("git_command"),
@@ -229,6 +483,8 @@ class GitClone(Source):
             raise WarningMessage("Cannot update, please check log for information")
 
     def prepare(self):
+        if option("git_cache"):
+            self.command("gitmirror", self._git_mirror)
         if not os.path.exists(self.git_path):
             self.command("gitinit", self._git_init)
         else:
@@ -240,11 +496,19 @@ class GitClone(Source):
 class Builder:
     subsource_dir = None
     dependencies = []
+    # Set to False if the build tree (not only the installed files) is used
+    # by other builders, as a build restored from the cache has none.
+    cacheable = True
+    # Commands depending only on the definition of the build, not on the
+    # content of the sources (a build system regenerates itself if needed).
+    definition_commands = ("pre_build_script", "configure", "post_configure_script")
 
     def __init__(self, target, source, buildEnv):
         self.target = target
         self.source = source
         self.buildEnv = buildEnv
+        self._fingerprints = {}
+        self._envs = {}
 
     @classmethod
     def get_dependencies(cls, configInfo, allDeps):
@@ -272,21 +536,32 @@ class Builder:
     def command(self, name, function, *args):
         print("  {} {} : ".format(name, self.name), end="", flush=True)
         log = pj(self._log_dir, "cmd_{}_{}.log".format(name, self.name))
-        context = Context(name, log, self.target.force_native_build)
+        kind = "definition" if name in self.definition_commands else "local"
+        context = Context(
+            name,
+            log,
+            self.target.force_native_build,
+            lambda: self.get_fingerprint(kind),
+        )
         if self.target.force_build:
             context.no_skip = True
+        status, exit_code = "ERROR", 0
+        start_time = time.time()
         try:
-            start_time = time.time()
             ret = function(*args, context=context)
             context._finalise()
             duration = time.time() - start_time
+            status = "OK"
             print(colorize("OK"), "({:.1f}s)".format(duration))
             return ret
         except SkipCommand as e:
+            status = "SKIP"
             print(e)
         except WarningMessage as e:
+            status = "WARNING"
             print(e)
-        except subprocess.CalledProcessError:
+        except subprocess.CalledProcessError as e:
+            exit_code = e.returncode
             print(colorize("ERROR"))
             try:
                 with open(log, "r") as f:
@@ -297,8 +572,83 @@ class Builder:
         except:
             print(colorize("ERROR"))
             raise
+        finally:
+            record_command(
+                self.buildEnv.configInfo.name,
+                self.target,
+                name,
+                status,
+                start_time,
+                context,
+                exit_code,
+            )
+
+    @property
+    def build_options(self):
+        """The options given to the build system by the builder."""
+        yield from getattr(self, "configure_options", [])
+
+    @property
+    def definition_inputs(self):
+        yield str(self.target.version())
+        yield hash_file(inspect.getsourcefile(self.target))
+        yield type(self).__qualname__
+        # The builder classes and the config define the commands run.
+        for cls in (*type(self).__mro__, *type(self.buildEnv.configInfo).__mro__):
+            if cls.__module__.startswith("kiwixbuild."):
+                yield hash_file(inspect.getsourcefile(cls))
+        yield self.buildEnv.fingerprint
+        yield str(option("make_release"))
+        yield str(self.target.force_native_build)
+        options = "\n".join(str(o) for o in self.build_options)
+        yield options.replace(option("working_dir"), "@WORKING_DIR@")
+
+    def get_fingerprint(self, kind):
+        """Hash of the inputs of the builder and of its dependencies.
+
+        `kind` is:
+        - "definition": the version, options, config and compilers.
+        - "local": the definition and the current state of the sources.
+        - "strict": the definition and the sources as released (or committed).
+          None if the sources have local changes."""
+        if kind not in self._fingerprints:
+            inputs = list(self.definition_inputs)
+            if kind == "strict":
+                inputs.append(self.source.fingerprint)
+            elif kind == "local":
+                inputs.append(self.source.local_fingerprint)
+            for dep in self.get_dependencies(self.buildEnv.configInfo, True):
+                depDef = self.buildEnv.configInfo.get_fully_qualified_dep(dep)
+                try:
+                    builder = get_target_step(depDef)
+                except KeyError:
+                    # Provided by a system package
+                    inputs.append("{}:{}".format(*depDef))
+                    continue
+                if builder is not self:
+                    inputs.append(builder.get_fingerprint(kind))
+            self._fingerprints[kind] = hash_inputs(inputs)
+        return self._fingerprints[kind]
+
+    @property
+    def fingerprint(self):
+        """Hash of everything affecting the files installed by the builder."""
+        return self.get_fingerprint("strict")
+
+    @property
+    def cache_key(self):
+        """Key of the builder in the artifact cache, None if not cached."""
+        if neutralEnv("artifact_cache") is None or option("build_nodeps"):
+            return None
+        if not self.cacheable:
+            return None
+        return self.fingerprint
 
     def build(self):
+        cache_key = self.cache_key
+        if cache_key is not None:
+            if self.command("cache_restore", self._cache_restore, cache_key):
+                return
         if hasattr(self, "_pre_build_script"):
             self.command("pre_build_script", self._pre_build_script)
         self.command("configure", self._configure)
@@ -307,10 +657,76 @@ class Builder:
         self.command("compile", self._compile)
         if hasattr(self, "_test"):
             self.command("test", self._test)
+        if cache_key is None:
+            with _install_lock:
+                self._install_step()
+            return
+        install_dir = self.buildEnv.install_dir
+        with _install_lock:
+            before = snapshot_tree(install_dir)
+            self._install_step()
+            files = changed_files(
+                before, snapshot_tree(install_dir), self.installed_files
+            )
+        if files:
+            self.command("cache_save", self._cache_save, cache_key, files)
+
+    def _install_step(self):
         self.command("install", self._install)
         if hasattr(self, "_post_build_script"):
             self.command("post_build_script", self._post_build_script)
 
+    @property
+    def install_manifest(self):
+        """The files installed by the build system, if it records them."""
+        return []
+
+    @property
+    def installed_files(self):
+        """The files of the install manifest, relative to the install dir."""
+        install_dir = self.buildEnv.install_dir
+        for path in self.install_manifest:
+            path = os.path.relpath(path, install_dir)
+            if not path.startswith(os.pardir + os.sep):
+                yield path
+
+    def install_command(self, name, function, *args):
+        """Run a command writing in the install dir."""
+        with _install_lock:
+            return self.command(name, function, *args)
+
+    @property
+    def _cache_stamp(self):
+        return pj(self.build_path, ".cache_key")
+
+    def _cache_restore(self, key, context):
+        try:
+            with open(self._cache_stamp, "r") as f:
+                if f.read() == key:
+                    # Already restored (or built and saved)
+                    return True
+        except FileNotFoundError:
+            pass
+        cache = neutralEnv("artifact_cache")
+        with _install_lock:
+            restored = cache.restore(self.target.name, key, self.buildEnv.install_dir)
+        if not restored:
+            raise SkipCommand("Not in cache")
+        self._write_cache_stamp(key)
+        return True
+
+    def _cache_save(self, key, files, context):
+        cache = neutralEnv("artifact_cache")
+        try:
+            cache.save(self.target.name, key, self.buildEnv.install_dir, files)
+        finally:
+            self._write_cache_stamp(key)
+
+    def _write_cache_stamp(self, key):
+        os.makedirs(self.build_path, exist_ok=True)
+        with open(self._cache_stamp, "w") as f:
+            f.write(key)
+
     def make_dist(self):
         if hasattr(self, "_pre_build_script"):
             self.command("pre_build_script", self._pre_build_script)
@@ -328,19 +744,27 @@ class Builder:
             module["config-opts"] = list(self.configure_options)
 
     def get_env(self, *, cross_comp_flags, cross_compilers, cross_path):
-        env = self.buildEnv.get_env(
-            cross_comp_flags=cross_comp_flags,
-            cross_compilers=cross_compilers,
-            cross_path=cross_path,
-        )
-        for dep in self.get_dependencies(self.buildEnv.configInfo, False):
-            try:
-                builder = get_target_step(dep, self.buildEnv.configInfo.name)
-                builder.set_env(env)
-            except KeyError:
-                # Some target may be missing (installed by a package, ...)
-                pass
-        return env
+        """The env to run the commands in (a copy the caller can modify).
+
+        It is computed once per set of flags, and again only if the env of
+        the process has changed."""
+        key = (cross_comp_flags, cross_compilers, cross_path)
+        env = self._envs.get(key)
+        if env is None or not env.is_current():
+            env = self.buildEnv.get_env(
+                cross_comp_flags=cross_comp_flags,
+                cross_compilers=cross_compilers,
+                cross_path=cross_path,
+            )
+            for dep in self.get_dependencies(self.buildEnv.configInfo, False):
+                try:
+                    builder = get_target_step(dep, self.buildEnv.configInfo.name)
+                    builder.set_env(env)
+                except KeyError:
+                    # Some target may be missing (installed by a package, ...)
+                    pass
+            env = self._envs[key] = FrozenEnv(env)
+        return env.mutable()
 
     def set_env(self, env):
         pass
@@ -380,7 +804,6 @@ class MakeBuilder(Builder):
     configure_options = []
     dynamic_configure_options = ["--enable-shared", "--disable-static"]
     static_configure_options = ["--enable-static", "--disable-shared"]
-    make_options = ["-j4"]
     install_options = []
     configure_script = "configure"
     configure_env = {
@@ -390,6 +813,13 @@ class MakeBuilder(Builder):
     make_targets = []
     flatpak_buildsystem = None
 
+    @property
+    def make_options(self):
+        if neutralEnv("jobserver") is not None:
+            # Number of jobs is given by the jobserver in MAKEFLAGS
+            return []
+        return ["-j{}".format(option("jobs"))]
+
     @property
     def make_install_targets(self):
         if self.buildEnv.configInfo.build in ("ios", "macos", "wasm"):
@@ -409,6 +839,15 @@ class MakeBuilder(Builder):
         yield from ("--prefix", self.buildEnv.install_dir)
         yield from ("--libdir", pj(self.buildEnv.install_dir, self.buildEnv.libprefix))
 
+    @property
+    def build_options(self):
+        yield self.configure_script
+        yield from self.all_configure_options
+        yield from ("{}={}".format(k, v) for k, v in (self.configure_env or {}).items())
+        yield from self.make_targets
+        yield from self.make_install_targets
+        yield from self.install_options
+
     def set_configure_env(self, env):
         dep_conf_env = self.configure_env
         if not dep_conf_env:
@@ -483,6 +922,14 @@ class CMakeBuilder(MakeBuilder):
         self.set_configure_env(env)
         run_command(command, self.build_path, context, env=env)
 
+    @property
+    def install_manifest(self):
+        try:
+            with open(pj(self.build_path, "install_manifest.txt"), "r") as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
     def set_flatpak_buildsystem(self, module):
         super().set_flatpak_buildsystem(module)
         module["buildir"] = True
@@ -498,6 +945,12 @@ class QMakeBuilder(MakeBuilder):
             return []
         return super().make_options
 
+    @property
+    def build_options(self):
+        yield from super().build_options
+        yield from self.env_options
+        yield from self.qmake_targets
+
     @property
     def env_options(self):
         if "QMAKE_CC" in os.environ:
@@ -552,6 +1005,24 @@ class MesonBuilder(Builder):
     def library_type(self):
         return "static" if self.buildEnv.configInfo.static else "shared"
 
+    @property
+    def ninja_jobs_option(self):
+        """The option giving its number of jobs to ninja.
+
+        None if ninja reads the jobserver itself (ninja >= 1.13)."""
+        jobserver = neutralEnv("jobserver")
+        if jobserver is not None and neutralEnv("ninja_version") >= (1, 13):
+            return None
+        return "-j{}"
+
+    @property
+    def build_options(self):
+        yield self.build_type
+        yield from self.strip_options
+        yield self.library_type
+        yield from self.configure_options
+        yield from self.test_options
+
     def _configure(self, context):
         context.try_skip(self.build_path)
         if os.path.exists(self.build_path):
@@ -584,7 +1055,13 @@ class MesonBuilder(Builder):
         env = self.get_env(
             cross_comp_flags=False, cross_compilers=False, cross_path=True
         )
-        run_command(command, self.build_path, context, env=env)
+        run_command(
+            command,
+            self.build_path,
+            context,
+            env=env,
+            jobs_option=self.ninja_jobs_option,
+        )
 
     def _test(self, context):
         context.try_skip(self.build_path)
@@ -597,7 +1074,14 @@ class MesonBuilder(Builder):
         env = self.get_env(
             cross_comp_flags=False, cross_compilers=False, cross_path=True
         )
-        run_command(command, self.build_path, context, env=env)
+        # `meson test` doesn't use the jobserver.
+        run_command(
+            command,
+            self.build_path,
+            context,
+            env=env,
+            jobs_option="--num-processes={}",
+        )
 
     def _install(self, context):
         context.try_skip(self.build_path)
@@ -605,7 +1089,22 @@ class MesonBuilder(Builder):
         env = self.get_env(
             cross_comp_flags=False, cross_compilers=False, cross_path=True
         )
-        run_command(command, self.build_path, context, env=env)
+        run_command(
+            command,
+            self.build_path,
+            context,
+            env=env,
+            jobs_option=self.ninja_jobs_option,
+        )
+
+    @property
+    def install_manifest(self):
+        path = pj(self.build_path, "meson-info", "intro-installed.json")
+        try:
+            with open(path, "r") as f:
+                return list(json.load(f).values())
+        except FileNotFoundError:
+            return []
 
     def _make_dist(self, context):
         command = [*neutralEnv("ninja_command"), "-v", "dist"]
@@ -16,7 +16,7 @@ class BoostRegex(Dependency):
 
     class Builder(BaseBuilder):
         def build(self):
-            self.command("copy_headers", self._copy_headers)
+            self.install_command("copy_headers", self._copy_headers)
 
         def _copy_headers(self, context):
             context.try_skip(self.build_path)
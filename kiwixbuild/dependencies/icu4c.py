@@ -6,7 +6,7 @@ from .base import (
 )
 
 from kiwixbuild.utils import pj, SkipCommand, Remotefile, extract_archive
-from kiwixbuild._global import get_target_step, neutralEnv
+from kiwixbuild._global import get_target_step, neutralEnv, option
 import os, shutil
 import fileinput
 import platform
@@ -25,9 +25,9 @@ if platform.system() == "Windows":
 
         class Builder(BaseBuilder):
             def build(self):
-                self.command("copy_headers", self._copy_headers)
-                self.command("copy_bins", self._copy_bin)
-                self.command("generate_pkg_config", self._generate_pkg_config)
+                self.install_command("copy_headers", self._copy_headers)
+                self.install_command("copy_bins", self._copy_bin)
+                self.install_command("generate_pkg_config", self._generate_pkg_config)
 
             def _copy_headers(self, context):
                 context.try_skip(self.build_path)
@@ -116,6 +116,8 @@ else:
 
     class Icu(Dependency):
         name = "icu4c"
+        memory_per_job = 600
+        build_time = 420
 
         class Source(ReleaseDownload):
             archive_src = Remotefile(
@@ -140,6 +142,7 @@ else:
                     neutralEnv("source_dir"),
                     topdir=None,
                     name=self.source_dir,
+                    decompressor=option("decompressor"),
                 )
                 shutil.rmtree(
                     pj(neutralEnv("source_dir"), self.source_dir, "source", "data")
@@ -166,6 +169,11 @@ else:
                 plt = "native_static" if configInfo.static else "native_dyn"
                 return [(plt, "icu4c")]
 
+            @property
+            def cacheable(self):
+                # The cross builds use the build tree of the native build.
+                return self.buildEnv.configInfo.build != "native"
+
             @property
             def configure_options(self):
                 yield "--disable-samples"
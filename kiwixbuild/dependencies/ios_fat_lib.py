@@ -46,5 +46,5 @@ class IOSFatLib(Dependency):
                 run_command(command, self.buildEnv.install_dir, context)
 
         def build(self):
-            self.command("copy_headers", self._copy_headers)
-            self.command("merge_libs", self._merge_libs)
+            self.install_command("copy_headers", self._copy_headers)
+            self.install_command("merge_libs", self._merge_libs)
@@ -5,7 +5,8 @@ import platform
 
 class KiwixDesktop(Dependency):
     name = "kiwix-desktop"
-    force_build = True
+    memory_per_job = 1500
+    build_time = 300
 
     class Source(GitClone):
         git_remote = "https://github.com/kiwix/kiwix-desktop.git"
@@ -3,7 +3,6 @@ from .base import Dependency, GitClone, MesonBuilder
 
 class KiwixTools(Dependency):
     name = "kiwix-tools"
-    force_build = True
 
     class Source(GitClone):
         git_remote = "https://github.com/kiwix/kiwix-tools.git"
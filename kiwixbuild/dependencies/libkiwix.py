@@ -7,7 +7,8 @@ from kiwixbuild._global import option, get_target_step, neutralEnv
 
 class Libkiwix(Dependency):
     name = "libkiwix"
-    force_build = True
+    memory_per_job = 1500
+    build_time = 300
 
     class Source(GitClone):
         git_remote = "https://github.com/kiwix/libkiwix.git"
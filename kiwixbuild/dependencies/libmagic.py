@@ -23,6 +23,11 @@ class LibMagic(Dependency):
         )
 
     class Builder(MakeBuilder):
+        @property
+        def cacheable(self):
+            # The cross builds run the `file` of the native build tree.
+            return self.buildEnv.configInfo.build != "native"
+
         @property
         def configure_options(self):
             yield "--disable-bzlib"
@@ -41,7 +46,7 @@ class LibMagic(Dependency):
             if configInfo.build == "native":
                 return super()._compile(context)
             context.try_skip(self.build_path)
-            command = ["make", "-j4", *self.make_targets, *self.make_options]
+            command = ["make", *self.make_targets, *self.make_options]
             env = self.buildEnv.get_env(
                 cross_comp_flags=True, cross_compilers=True, cross_path=True
             )
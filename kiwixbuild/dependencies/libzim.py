@@ -4,7 +4,8 @@ from kiwixbuild._global import option, get_target_step, neutralEnv
 
 class Libzim(Dependency):
     name = "libzim"
-    force_build = True
+    memory_per_job = 1000
+    build_time = 240
 
     class Source(GitClone):
         git_remote = "https://github.com/openzim/libzim.git"
@@ -16,7 +16,7 @@ class Mustache(Dependency):
 
     class Builder(BaseBuilder):
         def build(self):
-            self.command("copy_header", self._copy_header)
+            self.install_command("copy_header", self._copy_header)
 
         def _copy_header(self, context):
             context.try_skip(self.build_path)
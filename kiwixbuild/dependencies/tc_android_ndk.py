@@ -20,6 +20,15 @@ class android_ndk(Dependency):
             "https://dl.google.com/android/repository/android-ndk-r23c-linux.zip",
         )
 
+        # Only build/, prebuilt/ and toolchains/ are used to create
+        # the standalone toolchain.
+        extract_exclude = (
+            "python-packages",
+            "shader-tools",
+            "simpleperf",
+            "sources/third_party",
+        )
+
         @property
         def source_dir(self):
             return self.target.full_name()
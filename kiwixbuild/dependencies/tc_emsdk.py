@@ -18,6 +18,8 @@ class emsdk(Dependency):
             "https://codeload.github.com/emscripten-core/emsdk/tar.gz/refs/tags/3.1.41",
         )
 
+        extract_exclude = ("bazel", "docker", "test")
+
         @property
         def source_dir(self):
             return self.target.full_name()
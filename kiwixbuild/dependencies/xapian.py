@@ -8,6 +8,8 @@ import platform
 
 class Xapian(Dependency):
     name = "xapian-core"
+    memory_per_job = 800
+    build_time = 300
 
     if platform.system() == "Windows":
 
@@ -4,7 +4,6 @@ from kiwixbuild._global import neutralEnv
 
 class ZimTools(Dependency):
     name = "zim-tools"
-    force_build = True
 
     class Source(GitClone):
         git_remote = "https://github.com/openzim/zim-tools.git"
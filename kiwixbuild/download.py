@@ -0,0 +1,618 @@
+import os
+import ssl
+import json
+import time
+import hashlib
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import (
+    pj,
+    get_sha256,
+    get_verified_sha256,
+    set_verified_sha256,
+    remove_verified_sha256,
+    clone_file,
+    print_progress,
+    SkipCommand,
+    StopBuild,
+)
+from ._global import option, build_aborted
+
+
+class DownloadError(Exception):
+    pass
+
+
+class HTTPError(DownloadError):
+    """The server answered with an error. Retrying is useless."""
+
+
+class ChecksumError(DownloadError):
+    pass
+
+
+class _PrefixHasher:
+    """Compute the sha256 of a file while it is written, possibly out of order.
+
+    Data written right after the hashed part is hashed directly. Data written
+    further (by another segment) is read back from the file once everything
+    before it is written."""
+
+    read_size = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+        self._lock = threading.Lock()
+        self._reader = None
+
+    def update(self, offset, data, written):
+        """`data` has been written at `offset`, the file is complete up to `written`."""
+        with self._lock:
+            if offset == self.offset:
+                self.sha256.update(data)
+                self.offset += len(data)
+            self._catch_up(written)
+
+    def catch_up(self, written):
+        with self._lock:
+            self._catch_up(written)
+
+    def _catch_up(self, written):
+        if self.offset >= written:
+            return
+        if self._reader is None:
+            self._reader = open(self.path, "rb")
+        self._reader.seek(self.offset)
+        while self.offset < written:
+            data = self._reader.read(min(self.read_size, written - self.offset))
+            if not data:
+                raise DownloadError("{} is truncated".format(self.path))
+            self.sha256.update(data)
+            self.offset += len(data)
+
+    def hexdigest(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        return self.sha256.hexdigest()
+
+
+class ConnectionPool:
+    """Keep-alive http(s) connections, reused for the requests to the same host.
+
+    At most `max_per_host` connections to the same host are used at the
+    same time, other requests wait for a free one."""
+
+    max_redirects = 10
+    timeout = 60
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _ssl_context(self):
+        context = ssl.create_default_context()
+        if option("no_cert_check"):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _new_connection(self, scheme, netloc):
+        hostname = urllib.parse.urlsplit("//" + netloc).hostname
+        proxy = urllib.request.getproxies().get(scheme)
+        if proxy and not urllib.request.proxy_bypass(hostname):
+            if "://" not in proxy:
+                proxy = "http://" + proxy
+            proxy = urllib.parse.urlsplit(proxy)
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(
+                    proxy.hostname,
+                    proxy.port or 80,
+                    timeout=self.timeout,
+                    context=self._ssl_context(),
+                )
+                connection.set_tunnel(netloc)
+            else:
+                connection = http.client.HTTPConnection(
+                    proxy.hostname, proxy.port or 80, timeout=self.timeout
+                )
+                # A http proxy is given the full url.
+                connection.full_url = True
+            return connection
+        if scheme == "https":
+            return http.client.HTTPSConnection(
+                netloc, timeout=self.timeout, context=self._ssl_context()
+            )
+        if scheme == "http":
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise DownloadError("Unsupported url scheme {}".format(scheme))
+
+    def _target(self, connection, url):
+        if getattr(connection, "full_url", False):
+            return url
+        parsed = urllib.parse.urlsplit(url)
+        target = parsed.path or "/"
+        if parsed.query:
+            target += "?" + parsed.query
+        return target
+
+    def _request(self, key, url, headers):
+        """Send the request, on a idle connection if possible."""
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        while True:
+            reused = connection is not None
+            if not reused:
+                connection = self._new_connection(*key)
+            try:
+                connection.request(
+                    "GET", self._target(connection, url), headers=headers
+                )
+                return connection, connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection, use a new one.
+                connection = None
+
+    @contextmanager
+    def open(self, url, headers=None):
+        """Send a GET request (following redirections) and yield the response.
+
+        The connection is reused only if the response has been entirely read."""
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", "kiwix-build")
+        for _ in range(self.max_redirects):
+            parsed = urllib.parse.urlsplit(url)
+            key = (parsed.scheme, parsed.netloc)
+            with self._lock:
+                slots = self._slots.get(key)
+                if slots is None:
+                    slots = self._slots[key] = threading.BoundedSemaphore(
+                        self.max_per_host
+                    )
+            with slots:
+                connection, response = self._request(key, url, headers)
+                try:
+                    if response.status in (301, 302, 303, 307, 308):
+                        location = response.getheader("Location")
+                        response.read()
+                        url = urllib.parse.urljoin(url, location)
+                        continue
+                    response.url = url
+                    yield response
+                finally:
+                    if response.isclosed() and not response.will_close:
+                        with self._lock:
+                            self._idle.setdefault(key, []).append(connection)
+                    else:
+                        connection.close()
+                return
+        raise DownloadError("Too many redirections for {}".format(url))
+
+    def probe(self, url, size, timeout):
+        """Time to get the first `size` bytes of url, on a new connection.
+
+        Return None if it fails or takes more than `timeout` for a step."""
+        start = time.time()
+        headers = {"Range": "bytes=0-{}".format(size - 1), "User-Agent": "kiwix-build"}
+        try:
+            for _ in range(self.max_redirects):
+                parsed = urllib.parse.urlsplit(url)
+                connection = self._new_connection(parsed.scheme, parsed.netloc)
+                connection.timeout = timeout
+                try:
+                    target = self._target(connection, url)
+                    connection.request("GET", target, headers=headers)
+                    response = connection.getresponse()
+                    if response.status in (301, 302, 303, 307, 308):
+                        url = urllib.parse.urljoin(url, response.getheader("Location"))
+                        continue
+                    if response.status not in (200, 206):
+                        return None
+                    response.read(size)
+                    return time.time() - start
+                finally:
+                    connection.close()
+        except (OSError, http.client.HTTPException, DownloadError):
+            pass
+        return None
+
+
+class Downloader:
+    """Download files over http(s).
+
+    The file is written in `<path>.part` and renamed once complete. If the
+    download is interrupted, it is resumed from the `.part` file at the
+    next attempt (or the next run) with a Range request. Failed requests are
+    retried a few times.
+
+    Big files are downloaded in several segments at the same time (if the
+    server supports Range requests). Their progress is saved in
+    `<path>.part.json` so they can be resumed too.
+
+    If several urls are given, their hosts are probed (once per run) and
+    the fastest is used first. If it fails, the download is resumed from
+    the next one. Urls can also be `file://` urls of a local mirror."""
+
+    chunk_size = 1024 * 1024
+    segment_min_size = 32 * 1024 * 1024
+    segments = 4
+    retries = 5
+    probe_size = 64 * 1024
+    probe_timeout = 5
+
+    def __init__(self, max_per_host=4):
+        self.pool = ConnectionPool(max_per_host)
+        self._progress_lock = threading.Lock()
+        self._host_scores = {}
+        self._scores_lock = threading.Lock()
+
+    def rank_urls(self, urls):
+        """Sort the urls, local ones first and then by speed of their host."""
+        hosts = {}
+        for url in urls:
+            parsed = urllib.parse.urlsplit(url)
+            if parsed.scheme != "file":
+                hosts.setdefault(parsed.netloc, url)
+        with self._scores_lock:
+            to_probe = [
+                url for host, url in hosts.items() if host not in self._host_scores
+            ]
+            if len(hosts) > 1 and to_probe:
+                with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+                    scores = executor.map(
+                        lambda url: self.pool.probe(
+                            url, self.probe_size, self.probe_timeout
+                        ),
+                        to_probe,
+                    )
+                    for url, score in zip(to_probe, scores):
+                        host = urllib.parse.urlsplit(url).netloc
+                        self._host_scores[host] = score
+            scores = dict(self._host_scores)
+
+        def _key(url):
+            parsed = urllib.parse.urlsplit(url)
+            if parsed.scheme == "file":
+                return 0
+            score = scores.get(parsed.netloc)
+            # Not probed (single host) or failing hosts are kept in order.
+            return score if score is not None else float("inf")
+
+        # Sort is stable, hosts with same score keep their order
+        return sorted(urls, key=_key)
+
+    def download(self, urls, path, sha256=None):
+        """Download `urls` (one of them) in `path` and return its sha256.
+
+        The sha256 is computed while downloading. If `sha256` is given and
+        doesn't correspond, the download is removed and ChecksumError raised."""
+        if isinstance(urls, str):
+            urls = [urls]
+        urls = self.rank_urls(urls)
+        part_path = path + ".part"
+        state_path = part_path + ".json"
+        attempt = 0
+        while True:
+            url = urls[attempt % len(urls)]
+            try:
+                if urllib.parse.urlsplit(url).scheme == "file":
+                    digest = self._copy_local(url, part_path)
+                elif os.path.exists(state_path):
+                    digest = self._download_segments(url, part_path, state_path)
+                else:
+                    digest = self._download_stream(url, part_path, state_path)
+                break
+            except HTTPError:
+                # Not on this mirror, try the others.
+                if len(urls) == 1:
+                    raise
+                urls.remove(url)
+            except (OSError, http.client.HTTPException, DownloadError):
+                attempt += 1
+                if attempt > self.retries * len(urls) or build_aborted():
+                    raise
+                if attempt % len(urls) == 0:
+                    # All mirrors failed, wait before trying them again.
+                    time.sleep(2 ** (attempt // len(urls)))
+        if sha256 and digest != sha256:
+            os.remove(part_path)
+            raise ChecksumError("Sha 256 doesn't correspond")
+        os.replace(part_path, path)
+        return digest
+
+    def _copy_local(self, url, part_path):
+        local_path = urllib.request.url2pathname(urllib.parse.urlsplit(url).path)
+        if not os.path.isfile(local_path):
+            raise HTTPError("{} not found".format(local_path))
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        clone_file(local_path, part_path)
+        return get_sha256(part_path)
+
+    def _print_progress(self, current, total):
+        with self._progress_lock:
+            if total:
+                print_progress("{:.2%}".format(current / total))
+
+    def _download_stream(self, url, part_path, state_path):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": "bytes={}-".format(offset)}
+        with self.pool.open(url, headers) as response:
+            if response.status == 416:
+                response.read()
+                content_range = response.getheader("Content-Range", "")
+                if content_range == "bytes */{}".format(offset):
+                    # Already complete
+                    hasher = _PrefixHasher(part_path)
+                    hasher.catch_up(offset)
+                    return hasher.hexdigest()
+                # The .part file is not a prefix of the file, restart.
+                os.remove(part_path)
+                raise DownloadError("Cannot resume {}".format(url))
+            if response.status == 200:
+                offset = 0
+                total = response.getheader("Content-Length")
+                total = int(total) if total else None
+            elif response.status == 206:
+                start, total = _parse_content_range(response)
+                if start != offset:
+                    raise DownloadError("Invalid range received for {}".format(url))
+            elif response.status >= 500:
+                # The server may be temporarily unavailable, retry.
+                raise DownloadError("HTTP error {} for {}".format(response.status, url))
+            else:
+                raise HTTPError("HTTP error {} for {}".format(response.status, url))
+            segmented = (
+                response.status == 206
+                and offset == 0
+                and total >= self.segment_min_size
+                and self.segments > 1
+            )
+            if not segmented:
+                return self._copy_stream(response, part_path, offset, total)
+        # The first response is dropped (with its connection), so the
+        # segments can use all the connections allowed to the host.
+        segment_size = -(-total // self.segments)
+        state = {
+            "url": url,
+            "size": total,
+            "segments": [
+                [start, min(start + segment_size, total)]
+                for start in range(0, total, segment_size)
+            ],
+        }
+        with open(part_path, "wb") as f:
+            f.truncate(total)
+        _save_state(state_path, state)
+        return self._download_segments(url, part_path, state_path)
+
+    def _copy_stream(self, response, part_path, offset, total):
+        hasher = _PrefixHasher(part_path)
+        # Hash the part downloaded by a previous attempt.
+        hasher.catch_up(offset)
+        with open(part_path, "ab" if offset else "wb") as f:
+            while True:
+                if build_aborted():
+                    raise StopBuild("Build aborted")
+                data = response.read(self.chunk_size)
+                if not data:
+                    break
+                f.write(data)
+                hasher.update(offset, data, offset + len(data))
+                offset += len(data)
+                self._print_progress(offset, total)
+        if total is not None and offset != total:
+            raise DownloadError("Incomplete download of {}".format(response.url))
+        return hasher.hexdigest()
+
+    def _load_state(self, part_path, state_path):
+        """The state of the segmented download, None if it can't be resumed."""
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+            if os.path.getsize(part_path) >= state["size"]:
+                return state
+        except (OSError, ValueError, KeyError):
+            pass
+        # The .part file has been removed or truncated (or the state file is
+        # corrupted), the download is restarted from zero.
+        for file_path in (state_path, part_path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        return None
+
+    def _download_segments(self, url, part_path, state_path):
+        state = self._load_state(part_path, state_path)
+        if state is None:
+            return self._download_stream(url, part_path, state_path)
+        segments = state["segments"]
+        total = state["size"]
+        lock = threading.Lock()
+        last_save = [time.time()]
+        hasher = _PrefixHasher(part_path)
+
+        def _progress(segment, data):
+            with lock:
+                offset = segment[0]
+                segment[0] += len(data)
+                done = total - sum(end - start for start, end in segments)
+                # The file is complete up to the first unfinished segment.
+                written = next((s for s, e in segments if s < e), total)
+                if time.time() - last_save[0] > 1:
+                    _save_state(state_path, state)
+                    last_save[0] = time.time()
+            hasher.update(offset, data, written)
+            self._print_progress(done, total)
+
+        def _fetch(segment):
+            # Not buffered, so the hasher can read back what is written.
+            with open(part_path, "r+b", buffering=0) as f:
+                headers = {"Range": "bytes={}-{}".format(segment[0], segment[1] - 1)}
+                with self.pool.open(url, headers) as response:
+                    if response.status != 206:
+                        raise DownloadError("Range not supported for {}".format(url))
+                    self._copy_segment(response, f, segment, _progress)
+
+        todo = [segment for segment in segments if segment[0] < segment[1]]
+        try:
+            with ThreadPoolExecutor(max_workers=self.segments) as executor:
+                futures = [executor.submit(_fetch, segment) for segment in todo]
+                for future in futures:
+                    future.result()
+        finally:
+            with lock:
+                _save_state(state_path, state)
+        hasher.catch_up(total)
+        os.remove(state_path)
+        return hasher.hexdigest()
+
+    def _copy_segment(self, response, f, segment, progress):
+        f.seek(segment[0])
+        while segment[0] < segment[1]:
+            if build_aborted():
+                raise StopBuild("Build aborted")
+            data = response.read(min(self.chunk_size, segment[1] - segment[0]))
+            if not data:
+                raise DownloadError("Connection closed")
+            f.write(data)
+            progress(segment, data)
+
+
+def _parse_content_range(response):
+    """Return the start of the range and the size of the whole file."""
+    content_range = response.getheader("Content-Range", "")
+    try:
+        unit, value = content_range.split(" ", 1)
+        byte_range, total = value.split("/")
+        return int(byte_range.split("-")[0]), int(total)
+    except ValueError:
+        raise DownloadError("Invalid Content-Range {!r}".format(content_range))
+
+
+def _save_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+class DownloadCache:
+    """Archives shared between working dirs, stored by sha256.
+
+    Archives are hard linked in the archive dir of each working dir (or
+    reflinked/copied if they are on another file system). Their last use is
+    the mtime of a `.used` marker (touching the archive itself would change
+    the mtime of all its links). When the cache is bigger than `max_size`
+    (in MiB), the least recently used archives are removed. Archives still
+    linked in a working dir are kept, removing them would free no space."""
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, sha256):
+        return pj(self.path, sha256[:2], sha256)
+
+    def _touch(self, entry_path):
+        with open(entry_path + ".used", "w"):
+            pass
+
+    def get(self, sha256, path):
+        """Put the archive `sha256` in `path`. Return False if not in cache."""
+        entry_path = self._entry_path(sha256)
+        try:
+            clone_file(entry_path, path, hardlink=True)
+        except FileNotFoundError:
+            return False
+        self._touch(entry_path)
+        return True
+
+    def add(self, path, sha256):
+        entry_path = self._entry_path(sha256)
+        if not os.path.exists(entry_path):
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+            clone_file(path, tmp_path, hardlink=True)
+            os.replace(tmp_path, entry_path)
+        self._touch(entry_path)
+        self.trim(keep=entry_path)
+
+    def trim(self, keep=None):
+        if self.max_size is None:
+            return
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith((".used", ".tmp")):
+                    continue
+                entry_path = pj(root, name)
+                try:
+                    st = os.stat(entry_path)
+                except FileNotFoundError:
+                    # Removed by another build
+                    continue
+                try:
+                    used = os.stat(entry_path + ".used").st_mtime
+                except FileNotFoundError:
+                    used = 0
+                entries.append((used, st.st_size, st.st_nlink, entry_path))
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, nlink, entry_path in sorted(entries):
+            if total <= self.max_size * 1024 * 1024:
+                break
+            if entry_path == keep or nlink > 1:
+                continue
+            for p in (entry_path, entry_path + ".used"):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
+_downloader = Downloader()
+
+
+def download_remote(what, where, cache=None):
+    file_path = pj(where, what.name)
+    if os.path.exists(file_path):
+        if what.sha256 == get_verified_sha256(file_path):
+            raise SkipCommand()
+        os.remove(file_path)
+        remove_verified_sha256(file_path)
+
+    if cache is not None and what.sha256 and cache.get(what.sha256, file_path):
+        set_verified_sha256(file_path, what.sha256)
+        return
+
+    urls = [
+        "{}/{}".format(mirror.rstrip("/"), what.name) for mirror in option("mirror")
+    ]
+    try:
+        sha256 = _downloader.download(urls + what.urls, file_path, what.sha256)
+        set_verified_sha256(file_path, sha256)
+        if cache is not None and what.sha256:
+            cache.add(file_path, sha256)
+    except ChecksumError as e:
+        remove_verified_sha256(file_path)
+        raise StopBuild(str(e))
+    except (OSError, http.client.HTTPException, DownloadError) as e:
+        print("Cannot download {}\n{}".format(what.name, e))
+        raise StopBuild()
+
+    if not what.sha256:
+        print("Sha256 for {} not set, do no verify download".format(what.name))
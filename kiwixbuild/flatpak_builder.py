@@ -214,6 +214,8 @@ class FlatpakBuilder:
                             "sha256": archive.sha256,
                             "url": archive.url,
                         }
+                        if archive.mirrors:
+                            src["mirror-urls"] = list(archive.mirrors)
                         if hasattr(source, "flatpak_dest"):
                             src["dest"] = source.flatpak_dest
                         module_sources.append(src)
@@ -0,0 +1,141 @@
+import os
+import select
+import shutil
+import tempfile
+import atexit
+import threading
+
+from kiwixbuild.utils import StopBuild
+from kiwixbuild._global import build_aborted
+
+
+class Jobserver:
+    """A GNU make jobserver owned by kiwix-build.
+
+    The jobserver is a fifo containing one token per job allowed to run.
+    Each command launched by `run_command` takes a token (the implicit job
+    of the spawned make/ninja) and its children take the other tokens from
+    the same fifo, so all the commands share the same job budget.
+
+    The fifo is given to make with file descriptors (the only way supported
+    by make < 4.4) and to ninja (>= 1.13) with its path (the only way
+    supported by ninja). Commands not using the jobserver (older ninja,
+    `meson test`) take free tokens with `try_acquire` and are given their
+    number of jobs on their command line."""
+
+    token = b"+"
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self._tmpdir = tempfile.mkdtemp(prefix="kiwix-build-jobserver")
+        self.fifo_path = os.path.join(self._tmpdir, "fifo")
+        os.mkfifo(self.fifo_path, 0o600)
+        self.read_fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        self.write_fd = os.open(self.fifo_path, os.O_WRONLY)
+        # The read fd is shared with children, which expect it to be blocking.
+        os.set_blocking(self.read_fd, True)
+        self._try_read_fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        os.write(self.write_fd, self.token * jobs)
+        self.limit = jobs
+        self._withheld = []
+        self._limit_changed = threading.Condition()
+        self._governor = None
+        self._closed = False
+        atexit.register(self.close)
+
+    @property
+    def fds(self):
+        return (self.read_fd, self.write_fd)
+
+    def makeflags(self, fifo=False):
+        if fifo:
+            auth = "fifo:{}".format(self.fifo_path)
+        else:
+            auth = "{},{}".format(self.read_fd, self.write_fd)
+        return "-j{} --jobserver-auth={}".format(self.jobs, auth)
+
+    def set_env(self, env, command):
+        fifo = os.path.basename(command[0]).startswith("ninja")
+        env["MAKEFLAGS"] = self.makeflags(fifo)
+
+    def _wait_token(self, timeout):
+        """Take a token, waiting for it at most `timeout`. None if not taken."""
+        readable, _, _ = select.select([self._try_read_fd], [], [], timeout)
+        if not readable:
+            return None
+        try:
+            return os.read(self._try_read_fd, 1) or None
+        except BlockingIOError:
+            # Another process took the token before us.
+            return None
+
+    def acquire(self):
+        while True:
+            if build_aborted():
+                raise StopBuild("Build aborted")
+            token = self._wait_token(1)
+            if token:
+                return token
+
+    def try_acquire(self, count):
+        """Take up to `count` tokens without waiting for them."""
+        # The caller holds an implicit token. The limit may not be effective
+        # yet in the fifo (see `set_limit`).
+        count = min(count, self.limit - 1)
+        if count <= 0:
+            return b""
+        try:
+            return os.read(self._try_read_fd, count)
+        except BlockingIOError:
+            return b""
+
+    def release(self, token):
+        os.write(self.write_fd, token)
+
+    def set_limit(self, limit):
+        """Change the number of jobs allowed to run.
+
+        Tokens are withheld (or given back) by a background thread. As a
+        token can be held by a running job, reducing the limit is effective
+        only once enough jobs are finished."""
+        limit = max(1, min(limit, self.jobs))
+        with self._limit_changed:
+            self.limit = limit
+            if self._governor is None:
+                self._governor = threading.Thread(target=self._govern, daemon=True)
+                self._governor.start()
+            self._limit_changed.notify()
+
+    def _govern(self):
+        while True:
+            with self._limit_changed:
+                while (
+                    not self._closed and self.jobs - len(self._withheld) == self.limit
+                ):
+                    self._limit_changed.wait()
+                if self._closed:
+                    return
+                if self.jobs - len(self._withheld) < self.limit:
+                    self.release(self._withheld.pop())
+                    continue
+            # Wait for a token a limited time only, so the new limit (or the
+            # close of the jobserver) is seen.
+            try:
+                token = self._wait_token(1)
+            except OSError:
+                # The jobserver has been closed.
+                return
+            if token:
+                with self._limit_changed:
+                    self._withheld.append(token)
+
+    def close(self):
+        with self._limit_changed:
+            if self._closed:
+                return
+            self._closed = True
+            self._limit_changed.notify()
+        os.close(self.read_fd)
+        os.close(self._try_read_fd)
+        os.close(self.write_fd)
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
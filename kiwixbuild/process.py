@@ -0,0 +1,226 @@
+import os
+import selectors
+import subprocess
+import threading
+
+from ._global import build_aborted
+
+
+def poll_process(process):
+    """Return the resource usage of the process if it is finished, else None."""
+    if not hasattr(os, "wait4"):
+        if process.poll() is None:
+            return None
+        return ()
+    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    if not pid:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+class Child:
+    """A process run by the supervisor."""
+
+    def __init__(self, process, pipe, log_fd):
+        self.process = process
+        self.pipe = pipe
+        self.log_fd = log_fd
+        self.pidfd = None
+        self.rusage = None
+        self.aborted = False
+        # The exception raised by the supervisor while following the process.
+        self.error = None
+        self.done = threading.Event()
+        self._output = False
+
+    def take_output(self):
+        """Tell if the process has written something since the last call."""
+        output, self._output = self._output, False
+        return output
+
+
+class ProcessSupervisor:
+    """Run the commands and watch them from a single thread.
+
+    The output of each process is read from a pipe and written to its log as
+    soon as it comes. The end of the processes is watched with pidfds, so a
+    finished process is noticed at once (where pidfds are not available,
+    processes are checked every `poll_interval`). The threads running the
+    commands only wait for the `done` event of their child.
+    If the build is aborted, all running processes are terminated.
+    If the supervisor fails to follow a process, the error is given to the
+    thread waiting for it (and to all of them if the loop itself fails)."""
+
+    poll_interval = 0.05
+    abort_interval = 0.5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._new_children = []
+        self._children = set()
+        self._thread = None
+
+    def spawn(self, command, log_fd=None, **kwargs):
+        """Start `command`. Its output goes to `log_fd` (stdout if None)."""
+        pipe = None
+        if log_fd is not None:
+            pipe, write_end = os.pipe()
+            kwargs.update(stdout=write_end, stderr=subprocess.STDOUT)
+        try:
+            process = subprocess.Popen(command, **kwargs)
+        except BaseException:
+            if pipe is not None:
+                os.close(pipe)
+            raise
+        finally:
+            if pipe is not None:
+                os.close(write_end)
+        child = Child(process, pipe, log_fd)
+        with self._lock:
+            self._new_children.append(child)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="supervisor", daemon=True
+                )
+                self._thread.start()
+        os.write(self._wakeup_write, b"\0")
+        return child
+
+    def _add(self, child):
+        self._children.add(child)
+        if child.pipe is not None:
+            os.set_blocking(child.pipe, False)
+            self._selector.register(child.pipe, selectors.EVENT_READ, child)
+        try:
+            child.pidfd = os.pidfd_open(child.process.pid)
+        except (AttributeError, OSError):
+            # Not on linux (>= 5.3), the process is polled.
+            return
+        self._selector.register(child.pidfd, selectors.EVENT_READ, child)
+
+    def _read(self, child):
+        """Copy the available output of the child to its log.
+
+        Return False at the end of the output."""
+        while True:
+            try:
+                data = os.read(child.pipe, 65536)
+            except BlockingIOError:
+                return True
+            if not data:
+                return False
+            child._output = True
+            while data:
+                data = data[os.write(child.log_fd, data) :]
+
+    def _close_pipe(self, child):
+        self._selector.unregister(child.pipe)
+        os.close(child.pipe)
+        child.pipe = None
+
+    def _reap(self, child):
+        rusage = poll_process(child.process)
+        if rusage is None:
+            return
+        if child.pipe is not None:
+            # Processes started by the child may still have the pipe open,
+            # only read what is already written.
+            self._read(child)
+            self._close_pipe(child)
+        if child.pidfd is not None:
+            self._selector.unregister(child.pidfd)
+            os.close(child.pidfd)
+        self._children.discard(child)
+        child.rusage = rusage
+        child.done.set()
+
+    def _fail(self, child, error):
+        for fd in (child.pipe, child.pidfd):
+            if fd is None:
+                continue
+            try:
+                self._selector.unregister(fd)
+            except (KeyError, ValueError):
+                pass
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        child.pipe = child.pidfd = None
+        self._children.discard(child)
+        child.error = error
+        child.done.set()
+
+    def _abort(self):
+        for child in self._children:
+            if not child.aborted:
+                child.aborted = True
+                child.process.terminate()
+
+    def _run(self):
+        try:
+            self._loop()
+        except BaseException as e:
+            # A new thread is started by the next spawn.
+            with self._lock:
+                self._thread = None
+                new_children, self._new_children = self._new_children, []
+                for child in [*self._children, *new_children]:
+                    self._fail(child, e)
+            raise
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                new_children, self._new_children = self._new_children, []
+            for child in new_children:
+                try:
+                    self._add(child)
+                except Exception as e:
+                    self._fail(child, e)
+            if not self._children:
+                timeout = None
+            elif any(child.pidfd is None for child in self._children):
+                timeout = self.poll_interval
+            else:
+                timeout = self.abort_interval
+            for key, _ in self._selector.select(timeout):
+                child = key.data
+                if child is None:
+                    os.read(self._wakeup_read, 4096)
+                    continue
+                if child.done.is_set():
+                    # Reaped by a previous event of this batch.
+                    continue
+                try:
+                    if key.fd == child.pipe:
+                        if not self._read(child):
+                            self._close_pipe(child)
+                    else:
+                        self._reap(child)
+                except Exception as e:
+                    self._fail(child, e)
+            for child in [c for c in self._children if c.pidfd is None]:
+                try:
+                    self._reap(child)
+                except Exception as e:
+                    self._fail(child, e)
+            if self._children and build_aborted():
+                self._abort()
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor():
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ProcessSupervisor()
+        return _supervisor
@@ -0,0 +1,290 @@
+import sys
+import heapq
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .utils import StopBuild
+from ._global import abort_build
+
+_resources = {}
+
+
+def set_resource_limit(name, limit):
+    _resources[name] = threading.BoundedSemaphore(limit)
+
+
+@contextmanager
+def use_resource(name):
+    """Wait for a free slot of the resource `name` (if it is limited)."""
+    semaphore = _resources.get(name)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+
+def get_priorities(steps, duration):
+    """Longest path (in seconds) from the start of each step to the end of the build.
+
+    Starting the ready steps with the highest priority first gives the
+    priority to the critical path of the build."""
+    dependents = {stepDef: [] for stepDef in steps}
+    for stepDef, deps in steps.items():
+        for dep in deps:
+            if dep in dependents:
+                dependents[dep].append(stepDef)
+    priorities = {}
+
+    def _priority(stepDef):
+        if stepDef not in priorities:
+            followers = (_priority(d) for d in dependents[stepDef])
+            priorities[stepDef] = duration(stepDef) + max(followers, default=0)
+        return priorities[stepDef]
+
+    for stepDef in steps:
+        _priority(stepDef)
+    return priorities
+
+
+def get_critical_path(steps, priorities):
+    path = []
+    candidates = list(steps)
+    while candidates:
+        stepDef = max(candidates, key=lambda s: priorities[s])
+        path.append(stepDef)
+        candidates = [s for s, deps in steps.items() if stepDef in deps]
+    return path
+
+
+def simulate(steps, duration, jobs, source_jobs=None, priorities=None):
+    """Estimate the wall-clock time of running `steps` with a Scheduler."""
+    kinds = {"build": jobs}
+    if source_jobs is not None:
+        kinds["source"] = source_jobs
+
+    def _kind(stepDef):
+        return "source" if stepDef[0] == "source" and source_jobs else "build"
+
+    priorities = priorities or {}
+    order = {stepDef: i for i, stepDef in enumerate(steps)}
+    pending = dict(steps)
+    done = set()
+    running = []
+    now = 0
+    while pending or running:
+        ready = [
+            s
+            for s, deps in pending.items()
+            if all(d in done or d not in steps for d in deps)
+        ]
+        ready.sort(key=lambda s: (-priorities.get(s, 0), order[s]))
+        for stepDef in ready:
+            kind = _kind(stepDef)
+            if sum(1 for _, s in running if _kind(s) == kind) < kinds[kind]:
+                del pending[stepDef]
+                heapq.heappush(running, (now + duration(stepDef), stepDef))
+        if not running:
+            break
+        now, stepDef = heapq.heappop(running)
+        done.add(stepDef)
+    return now
+
+
+class MemoryBudget:
+    """Keep the memory used by the running steps under `max_memory`.
+
+    The projected memory is the number of jobs allowed by the jobserver
+    times the memory used by one job of the heaviest running step.
+    A new step is started only if each running step can still run at least
+    one job, and the jobserver is resized to the number of jobs fitting in
+    memory. This also limits the commands not using the jobserver (ninja <
+    1.13, meson test), which are given the number of tokens they can take."""
+
+    def __init__(self, max_memory, jobs, job_memory, jobserver=None):
+        self.max_memory = max_memory
+        self.jobs = jobs
+        self.job_memory = job_memory
+        self.jobserver = jobserver
+
+    def _memory_jobs(self, stepDefs):
+        """Number of jobs fitting in memory, None if not limited."""
+        peak = max((self.job_memory(stepDef) for stepDef in stepDefs), default=0)
+        if self.max_memory and peak:
+            return max(1, self.max_memory // peak)
+        return None
+
+    def max_jobs(self, stepDefs):
+        memory_jobs = self._memory_jobs(stepDefs)
+        if memory_jobs is None:
+            return self.jobs
+        return min(self.jobs, memory_jobs)
+
+    def can_start(self, stepDef, running):
+        if not running:
+            return True
+        memory_jobs = self._memory_jobs([*running, stepDef])
+        return memory_jobs is None or len(running) < memory_jobs
+
+    def update(self, running):
+        if self.jobserver is not None:
+            self.jobserver.set_limit(self.max_jobs(running))
+
+
+class StepOutput:
+    """A stdout replacement prefixing each line printed by a step.
+
+    Steps run in worker threads. Lines printed while a step is running on
+    the current thread are buffered until complete and then written atomically
+    with the step prefix, so the output of each step stays attributable.
+    Progress information is not printed, it would be mixed between steps."""
+
+    show_progress = False
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start_step(self, prefix):
+        self._local.prefix = prefix
+        self._local.buffer = ""
+
+    def end_step(self):
+        if self._local.buffer:
+            self.write("\n")
+        self._local.prefix = None
+
+    def write(self, text):
+        prefix = getattr(self._local, "prefix", None)
+        if prefix is None:
+            with self._lock:
+                return self._stream.write(text)
+        *lines, self._local.buffer = (self._local.buffer + text).split("\n")
+        if lines:
+            with self._lock:
+                for line in lines:
+                    self._stream.write("{}{}\n".format(prefix, line))
+                self._stream.flush()
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class Scheduler:
+    """Run the steps of a dependency graph in parallel.
+
+    `steps` is an ordered dict mapping each stepDef to the stepDefs it depends
+    on. When several steps are ready, they are started in the order of `steps`,
+    so the build order stays as close as possible to the serial one.
+
+    At most `jobs` builder steps run at the same time. If `source_jobs` is
+    given, source steps are counted apart and limited to `source_jobs`.
+    If a `memory_budget` is given, it also has to allow the step to start.
+    If `priorities` are given, ready steps with the highest priority are
+    started first.
+
+    On the first failing step, no new step is started, the running ones are
+    asked to stop and the error is raised once all workers are finished."""
+
+    def __init__(
+        self,
+        steps,
+        run_step,
+        jobs,
+        source_jobs=None,
+        memory_budget=None,
+        priorities=None,
+    ):
+        self.steps = steps
+        self.run_step = run_step
+        self.memory_budget = memory_budget
+        self.priorities = priorities or {}
+        self.jobs = {"build": jobs}
+        if source_jobs is not None:
+            self.jobs["source"] = source_jobs
+
+    def _kind(self, stepDef):
+        if stepDef[0] == "source" and "source" in self.jobs:
+            return "source"
+        return "build"
+
+    def _run_step(self, stepDef):
+        sys.stdout.start_step("[{} {}] ".format(*stepDef))
+        try:
+            self.run_step(stepDef)
+        finally:
+            sys.stdout.end_step()
+
+    def _ready_steps(self, pending, done):
+        ready = [
+            stepDef
+            for stepDef, deps in pending.items()
+            if all(dep in done or dep not in self.steps for dep in deps)
+        ]
+        # Sort is stable, steps with the same priority keep their order.
+        ready.sort(key=lambda stepDef: -self.priorities.get(stepDef, 0))
+        return ready
+
+    def _schedule(self, executor):
+        pending = dict(self.steps)
+        done = set()
+        running = {}
+        error = None
+        while pending or running:
+            if error is None:
+                for stepDef in self._ready_steps(pending, done):
+                    kind = self._kind(stepDef)
+                    used = sum(1 for s in running.values() if self._kind(s) == kind)
+                    if used >= self.jobs[kind]:
+                        continue
+                    if self.memory_budget is not None:
+                        running_steps = list(running.values())
+                        if not self.memory_budget.can_start(stepDef, running_steps):
+                            continue
+                        self.memory_budget.update([*running_steps, stepDef])
+                    del pending[stepDef]
+                    running[executor.submit(self._run_step, stepDef)] = stepDef
+            if not running:
+                if error is None:
+                    error = StopBuild("Cannot schedule steps {}".format(list(pending)))
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stepDef = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    if error is None:
+                        error = e
+                        abort_build()
+                else:
+                    done.add(stepDef)
+            if self.memory_budget is not None:
+                self.memory_budget.update(list(running.values()))
+        return error
+
+    def run(self):
+        stdout = sys.stdout
+        sys.stdout = StepOutput(stdout)
+        try:
+            workers = sum(self.jobs.values())
+            with ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="worker"
+            ) as executor:
+                try:
+                    error = self._schedule(executor)
+                except BaseException:
+                    # Let the running steps stop before waiting for them.
+                    abort_build()
+                    raise
+        finally:
+            sys.stdout = stdout
+        if error is not None:
+            raise error
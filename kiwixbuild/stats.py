@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+from .utils import pj
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    start_time REAL,
+    target TEXT,
+    config TEXT
+);
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    start_time REAL,
+    config TEXT,
+    dependency TEXT,
+    version TEXT,
+    command TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    wall_time REAL,
+    cpu_time REAL,
+    max_rss INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS commands_dependency ON commands(dependency, command);
+"""
+
+
+class StatsDB:
+    """Store the execution of every command in a sqlite database.
+
+    `status` is one of OK, SKIP, WARNING or ERROR. `max_rss` is in MiB."""
+
+    def __init__(self, path, target=None, config=None):
+        self.path = path
+        self.target = target
+        self.config = config
+        self._run_id = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    @property
+    def run_id(self):
+        if self._run_id is None:
+            cursor = self._db.execute(
+                "INSERT INTO runs (start_time, target, config) VALUES (?, ?, ?)",
+                (time.time(), self.target, self.config),
+            )
+            self._run_id = cursor.lastrowid
+        return self._run_id
+
+    def record(self, config, target, command, status, start_time, context, exit_code=0):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO commands (run_id, start_time, config, dependency, "
+                "version, command, status, exit_code, wall_time, cpu_time, max_rss, "
+                "read_bytes, write_bytes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.run_id,
+                    start_time,
+                    config,
+                    target.name,
+                    target.version(),
+                    command,
+                    status,
+                    exit_code,
+                    time.time() - start_time,
+                    context.cpu_time,
+                    context.max_rss,
+                    context.read_bytes,
+                    context.write_bytes,
+                ),
+            )
+            self._db.commit()
+
+    def get_max_rss(self, name):
+        """Max rss of the commands of the dependency, as measured last time."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT max(max_rss) FROM commands AS c WHERE dependency = ? "
+                "AND status = 'OK' AND max_rss > 0 AND id = ("
+                "  SELECT max(id) FROM commands WHERE dependency = c.dependency "
+                "  AND command = c.command AND status = 'OK' AND max_rss > 0)",
+                (name,),
+            ).fetchone()
+        return rows[0] or 0
+
+    def get_duration(self, config, name):
+        """Duration of a step, as the sum of the last duration of its commands.
+
+        Skipped commands are ignored. If the step has never been run for
+        `config`, the last durations measured for another config are used."""
+        sql = (
+            "SELECT sum(wall_time) FROM commands AS c WHERE dependency = ? "
+            "AND {config_filter} AND status != 'SKIP' AND id = ("
+            "  SELECT max(id) FROM commands WHERE dependency = c.dependency "
+            "  AND command = c.command AND {config_filter} AND status != 'SKIP')"
+        )
+        with self._lock:
+            duration = self._db.execute(
+                sql.format(config_filter="config = ?"), (name, config, config)
+            ).fetchone()[0]
+            if duration is None and config != "source":
+                duration = self._db.execute(
+                    sql.format(config_filter="config != 'source'"), (name,)
+                ).fetchone()[0]
+        return duration
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+
+def format_time(seconds):
+    if seconds is None:
+        return "-"
+    if seconds >= 60:
+        return "{}m{:04.1f}s".format(int(seconds // 60), seconds % 60)
+    return "{:.1f}s".format(seconds)
+
+
+def _print_table(headers, rows):
+    rows = [[str(c) for c in row] for row in rows]
+    widths = [max(len(r[i]) for r in [headers, *rows]) for i in range(len(headers))]
+    for row in [headers, *rows]:
+        print("  ".join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+
+
+def show_stats(stats, config=None, limit=20):
+    filter_ = "AND config = ?" if config else ""
+    params = (config,) if config else ()
+    runs = stats.query(
+        "SELECT id, start_time, target, config FROM runs "
+        "WHERE id IN (SELECT run_id FROM commands WHERE 1 {}) "
+        "ORDER BY id DESC LIMIT 1".format(filter_),
+        params,
+    )
+    if not runs:
+        print("No build recorded.")
+        return
+    last_run = runs[0]
+    print(
+        "[LAST RUN] {} ({} {})".format(
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last_run[1])),
+            last_run[2],
+            last_run[3],
+        )
+    )
+    print("[SLOWEST STEPS]")
+    rows = stats.query(
+        "SELECT config, dependency, command, wall_time, cpu_time, max_rss, "
+        "read_bytes, write_bytes FROM commands "
+        "WHERE run_id = ? AND status != 'SKIP' {} "
+        "ORDER BY wall_time DESC LIMIT ?".format(filter_),
+        (last_run[0], *params, limit),
+    )
+    _print_table(
+        [
+            "config",
+            "dependency",
+            "command",
+            "wall",
+            "cpu",
+            "rss(MiB)",
+            "read(MiB)",
+            "written(MiB)",
+        ],
+        [
+            (
+                c,
+                d,
+                cmd,
+                format_time(wall),
+                format_time(cpu),
+                rss,
+                (read or 0) // (1024 * 1024),
+                (written or 0) // (1024 * 1024),
+            )
+            for c, d, cmd, wall, cpu, rss, read, written in rows
+        ],
+    )
+    print("[TRENDS]")
+    # Compare the last non-skipped execution of each command with the
+    # average of the previous ones.
+    rows = stats.query(
+        "SELECT config, dependency, command, wall_time, "
+        "  (SELECT avg(wall_time) FROM commands AS p WHERE p.config = c.config "
+        "   AND p.dependency = c.dependency AND p.command = c.command "
+        "   AND p.status != 'SKIP' AND p.id < c.id), "
+        "  (SELECT count(*) FROM commands AS p WHERE p.config = c.config "
+        "   AND p.dependency = c.dependency AND p.command = c.command "
+        "   AND p.status != 'SKIP' AND p.id < c.id) "
+        "FROM commands AS c WHERE status != 'SKIP' {} AND id = ("
+        "  SELECT max(id) FROM commands WHERE config = c.config "
+        "  AND dependency = c.dependency AND command = c.command "
+        "  AND status != 'SKIP')".format(filter_),
+        params,
+    )
+    rows = [r for r in rows if r[4] is not None]
+    if not rows:
+        print("Not enough builds recorded.")
+        return
+    rows.sort(key=lambda r: r[3] - r[4], reverse=True)
+    _print_table(
+        ["config", "dependency", "command", "last", "average", "delta", "runs"],
+        [
+            (
+                c,
+                d,
+                cmd,
+                format_time(last),
+                format_time(avg),
+                "{:+.1f}s".format(last - avg),
+                count + 1,
+            )
+            for c, d, cmd, last, avg, count in rows[:limit]
+        ],
+    )
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="kiwix-build stats",
+        description="Show the slowest steps and their trends across builds.",
+    )
+    parser.add_argument("--working-dir", default=".")
+    parser.add_argument("--config", default=None, help="Only show this config.")
+    parser.add_argument(
+        "--limit", type=int, default=20, help="Number of steps to show."
+    )
+    options = parser.parse_args(args)
+    path = pj(os.path.abspath(options.working_dir), "stats.sqlite")
+    if not os.path.exists(path):
+        sys.exit("No stats database in {}".format(options.working_dir))
+    show_stats(StatsDB(path), options.config, options.limit)
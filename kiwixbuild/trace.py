@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Record the build timeline in the Trace Event Format.
+
+    The generated file can be opened with Perfetto (https://ui.perfetto.dev)
+    or chrome://tracing. Each thread running steps has its own track and
+    the cpu and memory usage of the host are sampled as counters.
+
+    If `path` is None, nothing is recorded."""
+
+    sample_interval = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = path is not None
+        self._events = []
+        self._tids = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._stop_sampling = threading.Event()
+        if self.enabled:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+            atexit.register(self.write)
+
+    def _ts(self, timestamp):
+        return int((timestamp - self._start) * 1000000)
+
+    def _tid(self):
+        thread = threading.current_thread()
+        tid = self._tids.get(thread.ident)
+        if tid is None:
+            tid = self._tids[thread.ident] = len(self._tids) + 1
+            self._events.append(
+                {
+                    "ph": "M",
+                    "name": "thread_name",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": thread.name},
+                }
+            )
+        return tid
+
+    def add_span(self, name, category, start_time, end_time=None, args=None):
+        if not self.enabled:
+            return
+        end_time = end_time or time.time()
+        with self._lock:
+            self._events.append(
+                {
+                    "ph": "X",
+                    "name": name,
+                    "cat": category,
+                    "pid": 1,
+                    "tid": self._tid(),
+                    "ts": self._ts(start_time),
+                    "dur": self._ts(end_time) - self._ts(start_time),
+                    "args": args or {},
+                }
+            )
+
+    @contextmanager
+    def span(self, name, category, args=None):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start_time, args=args)
+
+    def add_counter(self, name, values, timestamp=None):
+        with self._lock:
+            self._events.append(
+                {
+                    "ph": "C",
+                    "name": name,
+                    "pid": 1,
+                    "ts": self._ts(timestamp or time.time()),
+                    "args": values,
+                }
+            )
+
+    def _read_cpu_times(self):
+        with open("/proc/stat", "r") as f:
+            values = [int(v) for v in f.readline().split()[1:]]
+        # idle and iowait
+        idle = values[3] + values[4]
+        return sum(values) - idle, sum(values)
+
+    def _read_memory(self):
+        meminfo = {}
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0])
+        return (meminfo["MemTotal"] - meminfo["MemAvailable"]) // 1024
+
+    def _sample(self):
+        cpus = os.cpu_count() or 1
+        try:
+            last_busy, last_total = self._read_cpu_times()
+        except OSError:
+            # No /proc (not on linux), no counters.
+            return
+        while not self._stop_sampling.wait(self.sample_interval):
+            busy, total = self._read_cpu_times()
+            if total > last_total:
+                used = cpus * (busy - last_busy) / (total - last_total)
+                self.add_counter("cpu", {"busy cpus": round(used, 2)})
+            last_busy, last_total = busy, total
+            self.add_counter("memory", {"used (MiB)": self._read_memory()})
+
+    def write(self):
+        if not self.enabled:
+            return
+        self._stop_sampling.set()
+        with self._lock:
+            events = list(self._events)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -1,17 +1,22 @@
 import os.path
+import json
 import hashlib
 import tarfile, zipfile
-import tempfile
 import shutil
 import os, stat, sys
-import urllib.request
-import urllib.error
-import ssl
+import fnmatch
 import subprocess
+import multiprocessing
 import re
+import time
+import threading
 from collections import namedtuple, defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
-from kiwixbuild._global import neutralEnv, option
+from kiwixbuild._global import neutralEnv, option, build_aborted
+from kiwixbuild.process import get_supervisor, poll_process
 
 
 def pj(*args):
@@ -30,6 +35,22 @@ COLORS = {
 
 REMOTE_PREFIX = "https://dev.kiwix.org/kiwix-build/"
 
+# A dot is printed every LIVENESS_INTERVAL seconds if the running command
+# has written something in its log.
+LIVENESS_INTERVAL = 10
+
+# Zip archives bigger than that (uncompressed) are extracted in parallel.
+ZIP_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# External (multi-threaded) decompressors of tar archives, by extension.
+# The first one installed is used, python modules are used if none is.
+TAR_DECOMPRESSORS = [
+    ((".tar.gz", ".tgz"), [["pigz", "-dc"]]),
+    ((".tar.xz", ".txz"), [["xz", "-dc", "-T0"]]),
+    ((".tar.zst", ".tzst"), [["zstd", "-dc", "-T0"]]),
+    ((".tar.bz2", ".tbz2"), [["lbzip2", "-dc"], ["pbzip2", "-dc"]]),
+]
+
 
 def which(name):
     command = "which {}".format(name)
@@ -57,8 +78,8 @@ class Defaultdict(defaultdict):
 
 
 class DefaultEnv(Defaultdict):
-    def __init__(self):
-        super().__init__(str, os.environ)
+    def __init__(self, base=None):
+        super().__init__(str, os.environ if base is None else base)
 
     def __getitem__(self, name):
         if name == b"PATH":
@@ -74,6 +95,32 @@ class DefaultEnv(Defaultdict):
         return super().__getitem__(name)
 
 
+class FrozenEnv(Mapping):
+    """An immutable snapshot of an environment (all values are strings).
+
+    `mutable()` returns a DefaultEnv copy, to be modified by the caller."""
+
+    def __init__(self, env):
+        self._env = {k: str(v) for k, v in env.items()}
+        self._environ = dict(os.environ)
+
+    def __getitem__(self, name):
+        return self._env[name]
+
+    def __iter__(self):
+        return iter(self._env)
+
+    def __len__(self):
+        return len(self._env)
+
+    def is_current(self):
+        """Tell if the environment of the process has not changed since."""
+        return self._environ == os.environ
+
+    def mutable(self):
+        return DefaultEnv(self._env)
+
+
 def get_separator():
     return ";" if neutralEnv("distname") == "Windows" else ":"
 
@@ -102,22 +149,130 @@ def remove_duplicates(iterable, key_function=None):
         yield elem
 
 
+def get_cpu_count():
+    """Number of cpus this process can use, taking cgroup quota into account."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    quota = None
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        count = min(count, max(1, int(quota + 0.5)))
+    return count
+
+
+def get_memory_limit():
+    """Memory (in MiB) this process can use, taking cgroup limit into account."""
+    limit = None
+    for path in (
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ):
+        try:
+            with open(path) as f:
+                limit = int(f.read()) // (1024 * 1024)
+            break
+        except (OSError, ValueError):
+            # No such cgroup or no limit ("max")
+            continue
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        total //= 1024 * 1024
+    except (AttributeError, ValueError, OSError):
+        return limit
+    if limit is None:
+        return total
+    return min(limit, total)
+
+
+def parse_size(value):
+    """Parse a memory size in MiB. Suffixes M, G and T are accepted."""
+    units = {"M": 1, "G": 1024, "T": 1024 * 1024}
+    value = value.strip().upper().rstrip("B").rstrip("I")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 def get_sha256(path):
     progress_chars = "/-\\|"
     current = 0
-    batch_size = 1024 * 8
+    batch = bytearray(1024 * 1024)
+    view = memoryview(batch)
     sha256 = hashlib.sha256()
-    with open(path, "br") as f:
+    with open(path, "br", buffering=0) as f:
         while True:
-            batch = f.read(batch_size)
-            if not batch:
+            size = f.readinto(batch)
+            if not size:
                 break
-            sha256.update(batch)
+            sha256.update(view[:size])
             print_progress(progress_chars[current])
             current = (current + 1) % 4
     return sha256.hexdigest()
 
 
+def _verified_path(path):
+    dirname, name = os.path.split(path)
+    return pj(dirname, ".{}.verified".format(name))
+
+
+def _stat_key(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def get_verified_sha256(path):
+    """Sha256 of the file at `path`, cached in a sidecar file.
+
+    The sidecar stores the size, mtime and inode of the file when it was
+    hashed. The file is hashed again only if one of them has changed."""
+    st = os.stat(path)
+    try:
+        with open(_verified_path(path), "r") as f:
+            verified = json.load(f)
+        if verified["stat"] == _stat_key(st):
+            return verified["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+    sha256 = get_sha256(path)
+    set_verified_sha256(path, sha256, st)
+    return sha256
+
+
+def set_verified_sha256(path, sha256, st=None):
+    """Record that the file at `path` (as it was when `st` was taken) has `sha256`."""
+    st = st or os.stat(path)
+    verified_path = _verified_path(path)
+    tmp_path = verified_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"stat": _stat_key(st), "sha256": sha256}, f)
+    os.replace(tmp_path, verified_path)
+
+
+def remove_verified_sha256(path):
+    """Remove the sidecar recording the sha256 of the file at `path`."""
+    try:
+        os.remove(_verified_path(path))
+    except FileNotFoundError:
+        pass
+
+
 def colorize(text, color=None):
     if color is None:
         color = text
@@ -125,7 +280,7 @@ def colorize(text, color=None):
 
 
 def print_progress(progress):
-    if option("show_progress"):
+    if option("show_progress") and getattr(sys.stdout, "show_progress", True):
         text = "{}\033[{}D".format(progress, len(progress))
         print(text, end="")
 
@@ -135,6 +290,95 @@ def add_execution_right(file_path):
     os.chmod(file_path, current_permissions | stat.S_IXUSR)
 
 
+def _reflink(src, dst):
+    """Clone src into dst (copy on write). Return False if not supported."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_file(src, dst, hardlink=False):
+    """Copy src to dst, sharing the data on disk if possible.
+
+    If `hardlink`, dst is preferably a hard link to src (so none of them
+    must be modified in place). Else a reflink is tried before a copy."""
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    if not _reflink(src, dst):
+        shutil.copy2(src, dst)
+
+
+def clone_tree(src, dst, hardlink=False):
+    """Copy the tree src to dst, sharing the data of the files on disk if possible.
+
+    Files are reflinked (copy on write) if the filesystem supports it.
+    Else, if `hardlink`, they are hard linked (so none of the trees must be
+    modified in place), else they are copied."""
+    reflink = True
+    copied_dirs = []
+    for root, dirs, files in os.walk(src):
+        dstdir = pj(dst, os.path.relpath(root, src))
+        os.makedirs(dstdir, exist_ok=True)
+        copied_dirs.append((root, dstdir))
+        for name in dirs + files:
+            srcfile = pj(root, name)
+            dstfile = pj(dstdir, name)
+            if os.path.islink(srcfile):
+                os.symlink(os.readlink(srcfile), dstfile)
+                continue
+            if name in dirs:
+                continue
+            if reflink:
+                if _reflink(srcfile, dstfile):
+                    continue
+                # Do not try again for each file.
+                reflink = False
+            if hardlink:
+                try:
+                    os.link(srcfile, dstfile)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(srcfile, dstfile)
+    # Once their content is copied, as they may be read only.
+    for srcdir, dstdir in reversed(copied_dirs):
+        shutil.copymode(srcdir, dstdir)
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """Lock `path` against other processes (if supported by the platform).
+
+    A `shared` lock can be held by several processes at the same time, but
+    not with an exclusive one."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def copy_tree(src, dst, post_copy_function=None):
     os.makedirs(dst, exist_ok=True)
     for root, dirs, files in os.walk(src):
@@ -148,52 +392,6 @@ def copy_tree(src, dst, post_copy_function=None):
                 post_copy_function(dstfile)
 
 
-def download_remote(what, where):
-    file_path = pj(where, what.name)
-    if os.path.exists(file_path):
-        if what.sha256 == get_sha256(file_path):
-            raise SkipCommand()
-        os.remove(file_path)
-
-    if option("no_cert_check"):
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-    else:
-        context = None
-    batch_size = 1024 * 8
-    extra_args = {"context": context} if sys.version_info >= (3, 4, 3) else {}
-    progress_chars = "/-\\|"
-    try:
-        with urllib.request.urlopen(what.url, **extra_args) as resource, open(
-            file_path, "wb"
-        ) as file:
-            tsize = resource.info().get("Content-Length", None)
-            if tsize is not None:
-                tsize = int(tsize)
-            current = 0
-            while True:
-                batch = resource.read(batch_size)
-                if not batch:
-                    break
-                if tsize:
-                    current += batch_size
-                    print_progress("{:.2%}".format(current / tsize))
-                else:
-                    print_progress(progress_chars[current])
-                    current = (current + 1) % 4
-                file.write(batch)
-    except urllib.error.URLError as e:
-        print("Cannot download URL {}\n{}".format(what.url, e.reason))
-        raise StopBuild()
-
-    if not what.sha256:
-        print("Sha256 for {} not set, do no verify download".format(what.name))
-    elif what.sha256 != get_sha256(file_path):
-        os.remove(file_path)
-        raise StopBuild("Sha 256 doesn't correspond")
-
-
 class BaseCommandResult(Exception):
     def __init__(self, msg=""):
         self.msg = msg
@@ -218,157 +416,525 @@ class StopBuild(BaseCommandResult):
     pass
 
 
-class Remotefile(namedtuple("Remotefile", ("name", "sha256", "url"))):
-    def __new__(cls, name, sha256, url=None):
+class Remotefile(namedtuple("Remotefile", ("name", "sha256", "url", "mirrors"))):
+    """A file to download from `url` or one of the `mirrors` urls.
+
+    As the file is checked with its sha256, any mirror can be used."""
+
+    def __new__(cls, name, sha256, url=None, mirrors=()):
         if url is None:
             url = REMOTE_PREFIX + name
-        return super().__new__(cls, name, sha256, url)
+        return super().__new__(cls, name, sha256, url, tuple(mirrors))
+
+    @property
+    def urls(self):
+        return [self.url, *self.mirrors]
+
+
+# Resources used by a command. Times are in seconds, max_rss in MiB.
+CommandUsage = namedtuple(
+    "CommandUsage",
+    [
+        "wall_time",
+        "user_time",
+        "sys_time",
+        "max_rss",
+        "voluntary_switches",
+        "involuntary_switches",
+        "read_bytes",
+        "write_bytes",
+    ],
+)
 
 
 class Context:
-    def __init__(self, command_name, log_file, force_native_build):
+    def __init__(self, command_name, log_file, force_native_build, inputs=None):
         self.command_name = command_name
         self.log_file = log_file
         self.force_native_build = force_native_build
         self.autoskip_file = None
         self.no_skip = False
+        # Hash of the inputs of the command (or a function computing it).
+        # The command is skipped only if the autoskip file contains it.
+        self._inputs = inputs
+        # Resources used by the processes run in this context.
+        # Max rss (in MiB) is the one of the biggest process.
+        self.max_rss = 0
+        self.cpu_time = 0
+        self.user_time = 0
+        self.sys_time = 0
+        self.voluntary_switches = 0
+        self.involuntary_switches = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
 
     def skip(self, msg=""):
         raise SkipCommand(msg)
 
+    def add_usage(self, usage):
+        self.max_rss = max(self.max_rss, usage.max_rss)
+        self.cpu_time += usage.user_time + usage.sys_time
+        self.user_time += usage.user_time
+        self.sys_time += usage.sys_time
+        self.voluntary_switches += usage.voluntary_switches
+        self.involuntary_switches += usage.involuntary_switches
+        self.read_bytes += usage.read_bytes
+        self.write_bytes += usage.write_bytes
+
     def try_skip(self, path, extra_name=""):
         if self.no_skip:
             return
         if extra_name:
             extra_name = "_{}".format(extra_name)
         self.autoskip_file = pj(path, ".{}{}_ok".format(self.command_name, extra_name))
-        if os.path.exists(self.autoskip_file):
+        try:
+            with open(self.autoskip_file, "r") as f:
+                done_inputs = f.read()
+        except FileNotFoundError:
+            return
+        if done_inputs == self.inputs:
             raise SkipCommand()
 
+    @property
+    def inputs(self):
+        if callable(self._inputs):
+            self._inputs = self._inputs()
+        return self._inputs or ""
+
     def _finalise(self):
         if self.autoskip_file is not None:
             os.makedirs(os.path.dirname(self.autoskip_file), exist_ok=True)
-            with open(self.autoskip_file, "w"):
-                pass
-
+            with open(self.autoskip_file, "w") as f:
+                f.write(self.inputs)
+
+
+def _find_topdir(dir_names):
+    """The only top level directory, None if there is none or several."""
+    topdir = None
+    for name in dir_names:
+        if name.endswith("/"):
+            name = name[:-1]
+        if not os.path.dirname(name):
+            if topdir:
+                # There is already a top dir.
+                # Two topdirs in the same archive.
+                # Extract all
+                return None
+            topdir = name
+    return topdir
+
+
+def _safe_path(name):
+    """Path of an archive member, without absolute or parent parts."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    return os.path.join(*parts) if parts else ""
+
+
+def _extract_zip_member(archive, info, path):
+    if info.is_dir():
+        os.makedirs(path, exist_ok=True)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with archive.open(info) as src, open(path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    perm = (info.external_attr >> 16) & 0x1FF
+    if perm:
+        os.chmod(path, perm)
+
+
+def _extract_zip_members(archive_path, members):
+    """Extract the members (index in the archive, path) of a zip archive."""
+    with zipfile.ZipFile(archive_path) as archive:
+        infos = archive.infolist()
+        for index, path in members:
+            _extract_zip_member(archive, infos[index], path)
+
+
+def _extract_zip(archive_path, dest_dir, prefix, selected, jobs=None):
+    with zipfile.ZipFile(archive_path) as archive:
+        members = []
+        for index, info in enumerate(archive.infolist()):
+            if not info.filename.startswith(prefix):
+                continue
+            if not selected(info.filename[len(prefix) :]):
+                continue
+            path = _safe_path(info.filename[len(prefix) :])
+            if path:
+                members.append((index, info, pj(dest_dir, path)))
+    total_size = sum(info.file_size for _, info, _ in members)
+    if jobs == 1 or total_size < ZIP_PARALLEL_MIN_SIZE:
+        _extract_zip_members(archive_path, [(i, path) for i, _, path in members])
+        return
+
+    jobserver = neutralEnv("jobserver") if jobs is None else None
+    tokens = b""
+    if jobserver is not None:
+        # The processes are jobs of the build, as the ones of the commands.
+        tokens = jobserver.acquire()
+        tokens += jobserver.try_acquire(get_cpu_count() - 1)
+        jobs = len(tokens)
+    elif jobs is None:
+        jobs = min(get_cpu_count(), option("jobs"))
+    try:
+        _extract_zip_parallel(archive_path, members, jobs)
+    finally:
+        if tokens:
+            jobserver.release(tokens)
+
+
+def _extract_zip_parallel(archive_path, members, jobs):
+    if jobs == 1:
+        _extract_zip_members(archive_path, [(i, path) for i, _, path in members])
+        return
+
+    # Create the directories first, so the processes only write files.
+    for _, info, path in members:
+        os.makedirs(path if info.is_dir() else os.path.dirname(path), exist_ok=True)
+    # Split the files in ranges of consecutive members, so each process reads
+    # a contiguous part of the archive. There are more ranges than processes
+    # to balance the load.
+    files = sorted(
+        (m for m in members if not m[1].is_dir()), key=lambda m: m[1].header_offset
+    )
+    range_size = sum(info.compress_size for _, info, _ in files) / (jobs * 4)
+    ranges = [[]]
+    current_size = 0
+    for index, info, path in files:
+        if current_size > range_size:
+            ranges.append([])
+            current_size = 0
+        ranges[-1].append((index, path))
+        current_size += info.compress_size
+    # Do not fork, the build runs steps in threads.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        futures = [
+            executor.submit(_extract_zip_members, archive_path, r) for r in ranges
+        ]
+        for future in futures:
+            future.result()
+
+
+def _path_filter(include, exclude):
+    """Return a function telling if a member path is selected by the globs.
+
+    A glob matching a directory matches everything in it."""
+
+    def _match(path, patterns):
+        parts = path.strip("/").split("/")
+        return any(
+            fnmatch.fnmatchcase("/".join(parts[:i]), pattern)
+            for pattern in patterns
+            for i in range(1, len(parts) + 1)
+        )
 
-def extract_archive(archive_path, dest_dir, topdir=None, name=None):
-    is_zip_archive = archive_path.endswith(".zip")
-    archive = None
+    def selected(path):
+        if include and not _match(path, include):
+            return False
+        return not _match(path, exclude)
+
+    return selected
+
+
+def _find_decompressor(archive_path):
+    for extensions, commands in TAR_DECOMPRESSORS:
+        if archive_path.endswith(extensions):
+            for command in commands:
+                if shutil.which(command[0]):
+                    return command
+    return None
+
+
+@contextmanager
+def _open_tar(archive_path, decompressor="auto"):
+    """Open the tar archive for streaming.
+
+    If `decompressor` is "auto" and an external decompressor is installed
+    for the archive, it is used. Else the archive is decompressed by python."""
+    command = None
+    if decompressor == "auto":
+        command = _find_decompressor(archive_path)
+    if command is None:
+        with tarfile.open(archive_path, "r|*") as archive:
+            yield archive
+        return
+    process = subprocess.Popen(
+        command + [archive_path], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE
+    )
     try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+            yield archive
+        # Read the padding after the end of the archive, so the decompressor
+        # is not killed by a broken pipe.
+        while process.stdout.read(1024 * 1024):
+            pass
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command + [archive_path])
+
+
+def extract_archive(
+    archive_path,
+    dest_dir,
+    topdir=None,
+    name=None,
+    jobs=None,
+    decompressor="auto",
+    include=None,
+    exclude=(),
+):
+    """Extract the archive in dest_dir.
+
+    If the archive has a top directory (`topdir` or the only one found),
+    only its content is extracted, in `dest_dir/name` (default to topdir).
+    Members are written directly at their final place, in one pass.
+    Big zip archives are extracted by `jobs` processes (default to the
+    number of cpus). Tar archives are decompressed by an external
+    decompressor if `decompressor` is "auto", by python if "python".
+    If `include` globs are given, only the matching members are extracted.
+    Members matching one of the `exclude` globs are not extracted. Globs
+    are relative to the top directory."""
+    selected = _path_filter(include, exclude)
+    is_zip_archive = archive_path.endswith(".zip")
+    if not topdir:
         if is_zip_archive:
-            archive = zipfile.ZipFile(archive_path)
-            members = archive.infolist()
-            getname = lambda info: info.filename
-            isdir = lambda info: info.filename.endswith("/")
-        else:
-            archive = tarfile.open(archive_path)
-            members = archive.getmembers()
-            getname = lambda info: getattr(info, "name")
-            isdir = lambda info: info.isdir()
-        if not topdir:
-            for d in (m for m in members if isdir(m)):
-                _name = getname(d)
-                if _name.endswith("/"):
-                    _name = _name[:-1]
-                if not os.path.dirname(_name):
-                    if topdir:
-                        # There is already a top dir.
-                        # Two topdirs in the same archive.
-                        # Extract all
-                        topdir = None
-                        break
-                    topdir = _name
-        if topdir:
-            members_to_extract = [
-                m for m in members if getname(m).startswith(topdir + "/")
-            ]
-            os.makedirs(dest_dir, exist_ok=True)
-            with tempfile.TemporaryDirectory(
-                prefix=os.path.basename(archive_path), dir=dest_dir
-            ) as tmpdir:
-                if is_zip_archive:
-                    _members_to_extract = [getname(m) for m in members_to_extract]
-                else:
-                    _members_to_extract = members_to_extract
-                archive.extractall(path=tmpdir, members=_members_to_extract)
-                if is_zip_archive:
-                    for member in members_to_extract:
-                        if isdir(member):
-                            continue
-                        perm = (member.external_attr >> 16) & 0x1FF
-                        if perm:
-                            os.chmod(pj(tmpdir, getname(member)), perm)
-                name = name or topdir
-                shutil.copytree(
-                    pj(tmpdir, topdir),
-                    pj(dest_dir, name),
-                    symlinks=True,
-                    dirs_exist_ok=True,
+            with zipfile.ZipFile(archive_path) as archive:
+                topdir = _find_topdir(
+                    i.filename for i in archive.infolist() if i.is_dir()
                 )
-                # Be sure that all directory in tmpdir are writable to allow correct suppersion of it
-                for root, dirs, _files in os.walk(tmpdir):
-                    for d in dirs:
-                        os.chmod(
-                            pj(root, d), stat.S_IWRITE | stat.S_IREAD | stat.S_IEXEC
-                        )
-
         else:
-            if name:
-                dest_dir = pj(dest_dir, name)
-                os.makedirs(dest_dir)
-            archive.extractall(path=dest_dir)
-    finally:
-        if archive is not None:
-            archive.close()
+            # Only the compressed stream is read, nothing is written.
+            with _open_tar(archive_path, decompressor) as archive:
+                topdir = _find_topdir(m.name for m in archive if m.isdir())
+    if topdir:
+        prefix = topdir + "/"
+        dest_dir = pj(dest_dir, name or topdir)
+        os.makedirs(dest_dir, exist_ok=True)
+    else:
+        prefix = ""
+        if name:
+            dest_dir = pj(dest_dir, name)
+            os.makedirs(dest_dir)
+
+    if is_zip_archive:
+        _extract_zip(archive_path, dest_dir, prefix, selected, jobs)
+        return
+
+    def _members(archive):
+        for member in archive:
+            if not member.name.startswith(prefix):
+                continue
+            member.name = member.name[len(prefix) :]
+            if not member.name.strip("/") or not selected(member.name):
+                continue
+            if member.islnk() and member.linkname.startswith(prefix):
+                member.linkname = member.linkname[len(prefix) :]
+            dest = pj(dest_dir, member.name)
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                os.remove(dest)
+            yield member
+
+    with _open_tar(archive_path, decompressor) as archive:
+        archive.extractall(path=dest_dir, members=_members(archive))
+
+
+def _wait_process(process):
+    """Poll the process until it is finished (where pipes cannot be selected)."""
+    start_time = time.time()
+    last_dot = start_time
+    delay = 0.001
+    while True:
+        rusage = poll_process(process)
+        if rusage is not None:
+            break
+        if build_aborted():
+            process.terminate()
+            process.wait()
+            raise StopBuild("Build aborted")
+        if time.time() - last_dot > 30:
+            last_dot = time.time()
+            print(".", end="", flush=True)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    return rusage
+
+
+def _wait_child(child):
+    # Show the command is alive only if it is really doing something.
+    while not child.done.wait(LIVENESS_INTERVAL):
+        if child.take_output():
+            print(".", end="", flush=True)
+    if child.error is not None:
+        raise child.error
+    if child.aborted:
+        raise StopBuild("Build aborted")
+    return child.rusage
+
+
+def _command_usage(rusage, wall_time):
+    if not rusage:
+        # No rusage on this platform
+        return CommandUsage(wall_time, 0, 0, 0, 0, 0, 0, 0)
+    max_rss = rusage.ru_maxrss
+    # Linux gives the max rss in KiB, macOS in bytes
+    max_rss //= 1024 * 1024 if sys.platform == "darwin" else 1024
+    return CommandUsage(
+        wall_time,
+        rusage.ru_utime,
+        rusage.ru_stime,
+        max_rss,
+        rusage.ru_nvcsw,
+        rusage.ru_nivcsw,
+        # Block operations are counted in 512 bytes units
+        rusage.ru_inblock * 512,
+        rusage.ru_oublock * 512,
+    )
+
+
+def _print_usage(usage, returncode, log):
+    mib = 1024 * 1024
+    print("", file=log)
+    print("exit code: {}".format(returncode), file=log)
+    print("wall time: {:.2f}s".format(usage.wall_time), file=log)
+    print(
+        "cpu time: {:.2f}s user, {:.2f}s system".format(
+            usage.user_time, usage.sys_time
+        ),
+        file=log,
+    )
+    print("max rss: {} MiB".format(usage.max_rss), file=log)
+    print(
+        "context switches: {} voluntary, {} involuntary".format(
+            usage.voluntary_switches, usage.involuntary_switches
+        ),
+        file=log,
+    )
+    print(
+        "block io: {:.1f} MiB read, {:.1f} MiB written".format(
+            usage.read_bytes / mib, usage.write_bytes / mib
+        ),
+        file=log,
+    )
+
+
+def _write_env_snapshot(env, log_dir):
+    """Write env in a file of log_dir named by its content. Return its name.
+
+    Commands run with the same env share the same file."""
+    content = "".join("  {} : {!r}\n".format(k, v) for k, v in sorted(env.items()))
+    name = "env_{}.log".format(hashlib.sha256(content.encode()).hexdigest()[:16])
+    path = pj(log_dir, name)
+    if not os.path.exists(path):
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return name
+
+
+def _write_input(stdin, data):
+    # The process may exit without reading all its input (BrokenPipeError).
+    try:
+        stdin.write(data)
+    except BrokenPipeError:
+        pass
+    try:
+        stdin.close()
+    except BrokenPipeError:
+        pass
+
+
+def run_command(command, cwd, context, *, env=None, input=None, jobs_option=None):
+    """Run the command, logging its output in the log of the context.
 
+    `jobs_option` is given for a command not using the jobserver: it is
+    formatted with the number of jobs the command can run (its implicit job
+    and the free tokens it takes) and added to the command.
 
-def run_command(command, cwd, context, *, env=None, input=None):
+    Return the resources used by the command (a CommandUsage)."""
+    if build_aborted():
+        raise StopBuild("Build aborted")
     os.makedirs(cwd, exist_ok=True)
     if env is None:
         env = DefaultEnv()
     log = None
+    token = None
+    jobserver = neutralEnv("jobserver")
     try:
+        if jobserver is not None:
+            # The implicit job of the command
+            token = jobserver.acquire()
+        if jobs_option is not None:
+            if jobserver is not None:
+                token += jobserver.try_acquire(jobserver.jobs)
+                jobs = len(token)
+            else:
+                jobs = option("jobs")
+            command = [*command, jobs_option.format(jobs)]
         if not option("verbose"):
             log = open(context.log_file, "w")
         print("run command '{}'".format(command), file=log)
         print("current directory is '{}'".format(cwd), file=log)
-        print("env is :", file=log)
         env = {k: str(v) for k, v in env.items()}
-        for k, v in env.items():
-            print("  {} : {!r}".format(k, v), file=log)
+        kwargs = dict()
+        if jobserver is not None:
+            jobserver.set_env(env, command)
+            kwargs["pass_fds"] = jobserver.fds
+        if log:
+            log_dir = os.path.dirname(context.log_file)
+            print("env is in {}".format(_write_env_snapshot(env, log_dir)), file=log)
+        else:
+            print("env is :")
+            for k, v in env.items():
+                print("  {} : {!r}".format(k, v))
 
         if log:
             log.flush()
-        kwargs = dict()
         if input:
             kwargs["stdin"] = subprocess.PIPE
-        process = subprocess.Popen(
-            command,
-            cwd=cwd,
-            env=env,
-            stdout=log or sys.stdout,
-            stderr=subprocess.STDOUT,
-            **kwargs
-        )
+        start_time = time.time()
+        if os.name == "nt":
+            process = subprocess.Popen(
+                command,
+                cwd=cwd,
+                env=env,
+                stdout=log or sys.stdout,
+                stderr=subprocess.STDOUT,
+                **kwargs
+            )
+        else:
+            if not log:
+                kwargs.update(stdout=sys.stdout, stderr=subprocess.STDOUT)
+            child = get_supervisor().spawn(
+                command, log and log.fileno(), cwd=cwd, env=env, **kwargs
+            )
+            process = child.process
         if input:
-            input = input.encode()
-        while True:
-            try:
-                if input is None:
-                    process.wait(timeout=30)
-                else:
-                    process.communicate(input, timeout=30)
-            except subprocess.TimeoutExpired:
-                # Either `wait` timeout (and `input` is None) or
-                # `communicate` timeout (and we must set `input` to None
-                # to not communicate again).
-                input = None
-                print(".", end="", flush=True)
-            else:
-                break
+            # Written from a thread, the output of the process must be read
+            # while it reads its input (or it may block writing to a full pipe).
+            writer = threading.Thread(
+                target=_write_input, args=(process.stdin, input.encode()), daemon=True
+            )
+            writer.start()
+        if os.name == "nt":
+            rusage = _wait_process(process)
+        else:
+            rusage = _wait_child(child)
+        if input:
+            writer.join()
+        usage = _command_usage(rusage, time.time() - start_time)
+        context.add_usage(usage)
+        _print_usage(usage, process.returncode, log)
         if process.returncode:
             raise subprocess.CalledProcessError(process.returncode, command)
+        return usage
     finally:
+        if token is not None:
+            jobserver.release(token)
         if log:
             log.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Benchmark the extraction of a (synthetic) archive.
+
+Usage: bench_extract.py [--archive ARCHIVE] [--format FORMAT] [--size MiB]
+
+Zip archives are extracted serially and in parallel (--jobs N).
+Tar archives are decompressed by python and by the external decompressor.
+
+Without --archive, an archive of --size MiB (uncompressed) looking like a
+toolchain (many files, compressible content) is generated first."""
+
+import sys, os, io, time, shutil, random, tarfile, zipfile, tempfile, argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiwixbuild.utils import extract_archive, get_cpu_count, _find_decompressor
+
+FORMATS = {"zip": None, "tar.gz": "w:gz", "tar.xz": "w:xz", "tar.bz2": "w:bz2"}
+
+
+def generate_files(size):
+    words = [
+        bytes(random.choices(range(97, 123), k=random.randint(2, 10)))
+        for _ in range(2000)
+    ]
+    written = 0
+    index = 0
+    while written < size:
+        file_size = random.choice([4, 64, 512, 4096]) * 1024
+        content = b" ".join(random.choices(words, k=file_size // 6))[:file_size]
+        yield "toolchain/dir{}/file{}".format(index % 50, index), content
+        written += len(content)
+        index += 1
+
+
+def create_archive(path, format, size):
+    if format == "zip":
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, content in generate_files(size):
+                archive.writestr(name, content)
+        return
+    with tarfile.open(path, FORMATS[format]) as archive:
+        for name, content in generate_files(size):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+
+
+def bench(archive, runs, work_dir, **kwargs):
+    timings = []
+    for _ in range(runs):
+        dest = tempfile.mkdtemp(dir=work_dir)
+        start = time.monotonic()
+        extract_archive(archive, dest, name="out", **kwargs)
+        timings.append(time.monotonic() - start)
+        shutil.rmtree(dest)
+    return min(timings)
+
+
+def compare(name, reference, timing):
+    print("{}: {:.2f}s (x{:.2f})".format(name, timing, reference / timing))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive", help="Archive to extract")
+    parser.add_argument("--format", choices=list(FORMATS), default="zip")
+    parser.add_argument(
+        "--size", type=int, default=512, help="Size (MiB) of the generated archive"
+    )
+    parser.add_argument("--jobs", type=int, default=get_cpu_count())
+    parser.add_argument("--runs", type=int, default=3)
+
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        archive = args.archive
+        if archive is None:
+            archive = os.path.join(work_dir, "synthetic." + args.format)
+            print("Generating a {} MiB archive...".format(args.size))
+            create_archive(archive, args.format, args.size * 1024 * 1024)
+        if archive.endswith(".zip"):
+            serial = bench(archive, args.runs, work_dir, jobs=1)
+            print("serial: {:.2f}s".format(serial))
+            parallel = bench(archive, args.runs, work_dir, jobs=args.jobs)
+            compare("parallel ({} jobs)".format(args.jobs), serial, parallel)
+        else:
+            python = bench(archive, args.runs, work_dir, decompressor="python")
+            print("python: {:.2f}s".format(python))
+            command = _find_decompressor(archive)
+            if command is None:
+                print("No external decompressor installed for this archive.")
+            else:
+                external = bench(archive, args.runs, work_dir, decompressor="auto")
+                compare(" ".join(command), python, external)
+    finally:
+        shutil.rmtree(work_dir)